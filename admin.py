@@ -1,10 +1,36 @@
 from django.contrib import admin
 
+from .costing import set_exhausted
 from .models import (Consumer, Dish, GrainEvent, Ingredient,
                      IngredientCategory, Meal, Product, Ticket, Unit,
                      UserProfile, Vendor)
 
-admin.site.register(GrainEvent)
+
+class GrainEventAdmin(admin.ModelAdmin):
+    list_display = ['time', 'action', 'model', 'object_pk', 'user']
+    list_filter = ['action', 'model']
+    list_select_related = ['user']
+    # Counting a large log on every page is slow
+    show_full_result_count = False
+
+
+class IngredientAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'owner', 'purchase_date', 'exhausted']
+    list_filter = ['exhausted']
+    actions = ['finalise', 'definalise']
+
+    def finalise(self, request, queryset):
+        count = set_exhausted(queryset, True)
+        self.message_user(request, "Finalised %d ingredients" % count)
+    finalise.short_description = "Finalise selected ingredients"
+
+    def definalise(self, request, queryset):
+        count = set_exhausted(queryset, False)
+        self.message_user(request, "Definalised %d ingredients" % count)
+    definalise.short_description = "Definalise selected ingredients"
+
+
+admin.site.register(GrainEvent, GrainEventAdmin)
 admin.site.register(UserProfile)
 admin.site.register(Unit)
 admin.site.register(Consumer)
@@ -13,5 +39,5 @@ admin.site.register(Vendor)
 admin.site.register(Product)
 admin.site.register(Meal)
 admin.site.register(Dish)
-admin.site.register(Ingredient)
+admin.site.register(Ingredient, IngredientAdmin)
 admin.site.register(Ticket)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class GrainConfig(AppConfig):
     name = 'grain'
+
+    def ready(self):
+        from . import audit
+        audit.connect(self.get_models())
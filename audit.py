@@ -0,0 +1,230 @@
+"""Audit log for grain
+
+Every create, update and delete of a grain model is recorded as a
+``GrainEvent``, from model signals or, for bulk writes, which send none,
+by ``record_many`` and ``record_created``.  Costs and totals that the cost
+engine derives from those changes are not recorded.  Events are only
+buffered when recorded: those made inside a transaction are kept until it
+commits (and dropped if it, or their savepoint, rolls back), those made
+during a request until the response is ready, and each batch is written
+with a single ``bulk_create``, once per action, object and user.  With
+``GRAIN_AUDIT_BACKGROUND = True`` in the settings, batches are handed to a
+background thread instead of being written by the request; the thread is
+drained when the process exits.
+
+Old events are kept small by ``compact``, which keeps only the last of
+several edits an object had on one day, and ``archive``, which moves events
+to gzipped JSON lines files.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import signals
+from django.utils import timezone
+from django.utils.six.moves import queue
+
+from .models import CostEntry, GrainEvent, InventorySummary, SpendRollup
+
+# The log itself, and tables derived from other models
+NOT_AUDITED = (GrainEvent, InventorySummary, SpendRollup, CostEntry)
+BATCH = 1000
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def connect(models):
+    for model in models:
+        if model not in NOT_AUDITED:
+            signals.post_save.connect(saved, sender=model,
+                                      dispatch_uid="grain.audit.save")
+            signals.post_delete.connect(deleted, sender=model,
+                                        dispatch_uid="grain.audit.delete")
+
+
+def saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        record(GrainEvent.CREATE if created else GrainEvent.EDIT, instance)
+
+
+def deleted(sender, instance, **kwargs):
+    record(GrainEvent.DELETE, instance)
+
+
+@contextmanager
+def request_scope(user):
+    """Collect the events of a request, attributed to ``user``
+
+    Committed events are written once, when the block exits.
+    """
+    _local.user, _local.events = user, []
+    try:
+        yield
+    finally:
+        events, _local.user, _local.events = _local.events, None, None
+        flush(events)
+
+
+def _user_pk():
+    user = getattr(_local, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.pk
+
+
+def record(action, instance):
+    record_many(action, type(instance), [instance.pk])
+
+
+def record_many(action, model, pks):
+    """Record ``action`` on rows of ``model``, such as after a bulk update"""
+    if model in NOT_AUDITED:
+        return
+    user_pk = _user_pk()
+    events = [GrainEvent(action=action, model=model.__name__, object_pk=pk,
+                         user_id=user_pk) for pk in pks]
+    if not events:
+        return
+    # Django drops the hook if the transaction or savepoint rolls back
+    transaction.on_commit(partial(_committed, events))
+
+
+def record_created(model, objects, recent):
+    """Record the creation of ``objects`` just saved with ``bulk_create``
+
+    Where the backend does not set their primary keys (SQLite), they are
+    the newest rows of the queryset ``recent``: the transaction holds the
+    database's write lock until it commits.
+    """
+    pks = [obj.pk for obj in objects]
+    if None in pks:
+        pks = recent.order_by('-pk').values_list('pk', flat=True)[
+            :len(objects)]
+    record_many(GrainEvent.CREATE, model, pks)
+
+
+def _committed(events):
+    if getattr(_local, 'events', None) is not None:
+        _local.events.extend(events)
+    else:
+        flush(events)
+
+
+def flush(events):
+    """Write a batch of events, once per action, object and user"""
+    seen, unique = set(), []
+    for event in events:
+        key = (event.action, event.model, event.object_pk, event.user_id)
+        if key not in seen:
+            seen.add(key)
+            unique.append(event)
+    if not unique:
+        return
+    if getattr(settings, 'GRAIN_AUDIT_BACKGROUND', False):
+        worker().put(unique)
+    else:
+        GrainEvent.objects.bulk_create(unique)
+
+
+def worker():
+    """The background writer's queue, starting the thread if needed"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = queue.Queue()
+            thread = threading.Thread(target=_write, args=(_worker,),
+                                      name="grain-audit")
+            thread.daemon = True
+            thread.start()
+            atexit.register(wait)
+    return _worker
+
+
+def _write(events_queue):
+    while True:
+        events = events_queue.get()
+        try:
+            close_old_connections()
+            GrainEvent.objects.bulk_create(events)
+        except Exception:
+            # Keep the thread alive for later batches
+            logger.exception("Could not write %d audit events", len(events))
+        finally:
+            events_queue.task_done()
+
+
+def wait():
+    """Block until the background writer has written everything queued"""
+    if _worker is not None:
+        _worker.join()
+
+
+def _day(time):
+    if timezone.is_aware(time):
+        time = timezone.localtime(time)
+    return time.date()
+
+
+def compact(before):
+    """Drop all but the last edit per object, user and day before ``before``
+
+    Creations and deletions are kept.  Returns the number of events removed.
+    """
+    edits = GrainEvent.objects.filter(
+        action=GrainEvent.EDIT, time__lt=before).order_by(
+        'model', 'object_pk', 'user', 'time', 'pk').values_list(
+        'pk', 'model', 'object_pk', 'user', 'time')
+
+    doomed, last = [], None
+    for pk, model, object_pk, user_pk, time in edits.iterator():
+        key = (model, object_pk, user_pk, _day(time))
+        if last is not None and key == last[0]:
+            doomed.append(last[1])
+        last = key, pk
+
+    for i in range(0, len(doomed), BATCH):
+        GrainEvent.objects.filter(pk__in=doomed[i:i + BATCH]).delete()
+    return len(doomed)
+
+
+def archive(before, directory, chunk=BATCH):
+    """Move events before ``before`` to a gzipped JSON lines file
+
+    Events are read ``chunk`` at a time and only deleted once the file is
+    complete.  Returns the file's path and the number of events, or None if
+    there was nothing to archive.
+    """
+    events = GrainEvent.objects.filter(time__lt=before).order_by('pk')
+
+    def rows_after(pk):
+        return list(events.filter(pk__gt=pk).values(
+            'pk', 'action', 'model', 'object_pk', 'user', 'user__username',
+            'time')[:chunk])
+
+    rows = rows_after(0)
+    if not rows:
+        return None
+    # Archived events are deleted, so the first pk names the file uniquely
+    path = os.path.join(directory, "grain-events-%s-%d.jsonl.gz" % (
+        timezone.now().strftime("%Y%m%d"), rows[0]['pk']))
+    count = 0
+    with gzip.open(path, 'wb') as out:
+        while rows:
+            for row in rows:
+                row['time'] = row['time'].isoformat()
+                out.write(json.dumps(row, sort_keys=True).encode() + b"\n")
+            count += len(rows)
+            last_pk = rows[-1]['pk']
+            rows = rows_after(last_pk)
+
+    events.filter(pk__lte=last_pk).delete()
+    return path, count
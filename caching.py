@@ -0,0 +1,284 @@
+"""Cached fragments for grain
+
+Fragments are stored under versioned keys.  Invalidating a fragment bumps
+its version key instead of hunting down every stored variant, and versions
+start from the current time so an evicted version key never resurrects a
+stale fragment.  Hits and misses are counted in the cache itself, so the
+counters are shared between worker processes.
+"""
+import time
+from datetime import date, timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.functions import TruncDay
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from moneyed import Money
+
+from .inventory import expiring
+from .models import IngredientCategory, Meal, Product
+
+FRAGMENT_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def _incr(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        return cache.incr(key)
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(key, version, None)
+    return version
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), None)
+
+
+def record(name, hit):
+    _incr("grain:stats:%s:%s" % (name, "hits" if hit else "misses"))
+
+
+def get_stats(*names):
+    stats = {}
+    for name in names:
+        stats[name] = {
+            'hits': cache.get("grain:stats:%s:hits" % name, 0),
+            'misses': cache.get("grain:stats:%s:misses" % name, 0),
+        }
+    return stats
+
+
+def get_or_build(name, key, build, timeout=FRAGMENT_TIMEOUT):
+    """Cached value for ``key``, built and stored on a miss"""
+    value = cache.get(key)
+    record(name, value is not None)
+    if value is None:
+        value = build()
+        cache.set(key, value, timeout)
+    return value
+
+
+def next_month(month):
+    if month.month == 12:
+        return date(month.year + 1, 1, 1)
+    return date(month.year, month.month + 1, 1)
+
+
+def calendar_grid(month):
+    """First and (exclusive) last day of a month's calendar grid"""
+    following = next_month(month)
+    return (month - timedelta(days=month.weekday()),
+            following + timedelta(days=-following.weekday() % 7))
+
+
+def calendar_months(day):
+    """Every month whose calendar grid shows ``day``"""
+    month = day.replace(day=1)
+    months = [month]
+    following = next_month(month)
+    if day >= calendar_grid(following)[0]:
+        months.append(following)
+    previous = (month - timedelta(days=1)).replace(day=1)
+    if day < calendar_grid(previous)[1]:
+        months.append(previous)
+    return months
+
+
+def _calendar_version_key(month, profile_pk=None, user_pk=None,
+                          currency=None):
+    if user_pk is None:
+        return "grain:cal:full:%s:%s" % (profile_pk, month.strftime("%Y-%m"))
+    return "grain:cal:own:%s:%s:%s" % (user_pk, currency,
+                                       month.strftime("%Y-%m"))
+
+
+def calendar_versions(profile_pk, start, end):
+    """Versions of a profile's calendar months from ``start`` to ``end``
+
+    Any change to the profile's meals between the two dates changes one of
+    them, which makes them suitable for an ETag.
+    """
+    month, versions = start.replace(day=1), []
+    while month <= end:
+        versions.append(_version(_calendar_version_key(month,
+                                                       profile_pk=profile_pk)))
+        month = next_month(month)
+    return versions
+
+
+def calendar(month, meals, profile, user=None):
+    """Rendered calendar grid for a profile's month, from the cache
+
+    With ``user`` this is the personal variant: that user's meals in the
+    profile currency, across profiles.
+    """
+    from .templatetags.grain_extras import calendar as calendar_context
+
+    if user is None:
+        version_key = _calendar_version_key(month, profile_pk=profile.pk)
+    else:
+        version_key = _calendar_version_key(month, user_pk=user.pk,
+                                            currency=profile.currency)
+    first, last = calendar_grid(month)
+    today = date.today()
+    key = "grain:cal:frag:%s:%s:%s" % (
+        profile.pk, version_key, _version(version_key))
+    if first <= today < last:
+        key += ":%s" % today.isoformat()
+
+    return mark_safe(get_or_build("calendar", key, lambda: render_to_string(
+        'grain/cal/calendar.html', calendar_context(month, meals))))
+
+
+def invalidate_calendar(when, profile_pk, currency, user_pk=None):
+    """Drop cached calendars showing a meal at ``when``"""
+    if timezone.is_aware(when):
+        when = timezone.localtime(when)
+    for month in calendar_months(when.date()):
+        _bump(_calendar_version_key(month, profile_pk=profile_pk))
+        if user_pk is not None:
+            _bump(_calendar_version_key(month, user_pk=user_pk,
+                                        currency=currency))
+
+
+def invalidate_meals(meal_pks):
+    """Drop cached calendars showing any of the meals, once committed
+
+    The meals are looked up immediately, so this works for meals that are
+    about to be deleted.
+    """
+    meal_pks, rows = list(meal_pks), set()
+    for i in range(0, len(meal_pks), 500):
+        rows.update(Meal.objects.filter(pk__in=meal_pks[i:i + 500])
+                                .values_list('time', 'owner_id',
+                                             'cost_closed_currency',
+                                             'consumer__actual_user_id'))
+
+    def invalidate():
+        for row in rows:
+            invalidate_calendar(*row)
+    if rows:
+        transaction.on_commit(invalidate)
+
+
+def invalidate_consumer(consumer_pk):
+    """Drop cached calendars showing a consumer's meals, once committed
+
+    For a renamed consumer; each day with its meals is looked up once.
+    """
+    rows = set(Meal.objects.filter(consumer=consumer_pk).annotate(
+        day=TruncDay('time')).values_list(
+        'day', 'owner_id', 'cost_closed_currency',
+        'consumer__actual_user_id').distinct())
+
+    def invalidate():
+        for row in rows:
+            invalidate_calendar(*row)
+    if rows:
+        transaction.on_commit(invalidate)
+
+
+def inventory_key(profile_pk, name):
+    """Cache key for ``name``, valid until the profile's inventory changes"""
+    version_key = "grain:inv:%s" % profile_pk
+    return "%s:%s:%s" % (version_key, _version(version_key), name)
+
+
+def invalidate_inventory(profile_pks):
+    """Drop everything cached against the profiles' inventory, once committed
+    """
+    profile_pks = set(profile_pks)
+
+    def invalidate():
+        for pk in profile_pks:
+            _bump("grain:inv:%s" % pk)
+    if profile_pks:
+        transaction.on_commit(invalidate)
+
+
+def product_catalogue(currency):
+    """Products priced in ``currency``, with vendor, units and categories
+
+    Category name lists are filled in too, so the cached products render
+    without further queries.
+    """
+    def build():
+        products = list(Product.objects.filter(price__gt=Money(0, currency))
+                                       .select_related('vendor', 'units',
+                                                       'category'))
+        IngredientCategory.prefetch_parent_names(
+            product.category for product in products)
+        return products
+
+    version_key = "grain:catalogue"
+    return get_or_build("catalogue", "%s:%s:%s" % (
+        version_key, _version(version_key), currency), build)
+
+
+def catalogue_products(currency, pks):
+    """Products of ``product_catalogue(currency)`` by pk, for a few pks
+
+    Each product is also cached on its own under the catalogue's version, so
+    a lookup neither loads the whole catalogue nor scans it.
+    """
+    if not pks:
+        return {}
+    version_key = "grain:catalogue"
+    prefix = "%s:%s:%s:" % (version_key, _version(version_key), currency)
+    keys = {prefix + str(pk): pk for pk in pks}
+    products = {keys[key]: product
+                for key, product in cache.get_many(keys).items()}
+    missing = [pk for pk in keys.values() if pk not in products]
+    record("catalogue", not missing)
+    if missing:
+        built = list(Product.objects.filter(
+            pk__in=missing, price__gt=Money(0, currency)).select_related(
+            'vendor', 'units', 'category'))
+        IngredientCategory.prefetch_parent_names(
+            product.category for product in built)
+        cache.set_many({prefix + str(product.pk): product
+                        for product in built}, FRAGMENT_TIMEOUT)
+        products.update((product.pk, product) for product in built)
+    return products
+
+
+def invalidate_catalogue():
+    """Drop every cached product catalogue, once committed"""
+    transaction.on_commit(lambda: _bump("grain:catalogue"))
+
+
+def expiring_soon(profile_pk):
+    """Today's ``inventory.expiring`` for a profile, from the cache
+
+    The list only changes with the date or when ingredients are added,
+    edited, exhausted or removed, not with their usage, so it has its own
+    version rather than the inventory's.
+    """
+    today = date.today()
+    version_key = "grain:expiring:%s" % profile_pk
+    return get_or_build("expiring", "%s:%s:%s" % (
+        version_key, _version(version_key), today.isoformat()),
+        lambda: expiring(profile_pk, today))
+
+
+def invalidate_expiring(profile_pks):
+    """Drop the profiles' cached expiry alerts, once committed"""
+    profile_pks = set(profile_pks)
+
+    def invalidate():
+        for pk in profile_pks:
+            _bump("grain:expiring:%s" % pk)
+    if profile_pks:
+        transaction.on_commit(invalidate)
@@ -0,0 +1,434 @@
+"""Set-based cost propagation for grain
+
+Ticket costs are denormalised into running totals on ``Dish`` and ``Meal``.
+Rather than saving every affected object in turn, the functions here compute
+each new ticket cost once, aggregate the per-dish and per-meal deltas in
+memory, and write everything back with a handful of bulk UPDATEs inside one
+transaction.
+
+In ledger mode (``GRAIN_COST_LEDGER = True`` in the settings) the dish and
+meal totals are not touched on write.  Every change to a ticket's cost is
+appended to ``CostEntry`` instead, and ``compact_ledger`` folds new entries
+into the totals; run it periodically (``manage.py compact_ledger``).  The
+ledger is an audit trail of every cost change, and ``recompute_from_ledger``
+rebuilds the totals from it without any cascade.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Case, F, Sum, Value, When
+from moneyed import Money
+
+from . import audit
+from .caching import (invalidate_expiring, invalidate_inventory,
+                      invalidate_meals)
+from .inventory import InventoryChanges, remember, state
+from .rollups import SpendChanges, rebuild as rebuild_rollups
+from .models import CostEntry, Dish, GrainEvent, Ingredient, Meal, Ticket
+
+COST_PLACES = Decimal('0.0001')     # decimal_places of the cost MoneyFields
+UPDATE_BATCH = 100                  # rows per UPDATE, keeps SQLite params low
+
+_COST_FIELD = models.DecimalField(max_digits=10, decimal_places=4)
+_OUTPUT_FIELDS = {
+    'cost': _COST_FIELD,
+    'cost_open': _COST_FIELD,
+    'cost_closed': _COST_FIELD,
+    'final': models.BooleanField(),
+    'exhausted': models.BooleanField(),
+    'used_amount': models.FloatField(),
+}
+
+
+def ledger_mode():
+    return getattr(settings, 'GRAIN_COST_LEDGER', False)
+
+
+def quantize_cost(amount):
+    return Decimal(amount).quantize(COST_PLACES)
+
+
+def cost_field(final):
+    """Name of the dish/meal running total a ticket's cost is held in"""
+    return 'cost_closed' if final else 'cost_open'
+
+
+def cost_per_unit(price, used_amount):
+    if used_amount != 0:
+        return price * (1 / used_amount)
+    return Money(0, price.currency.code)
+
+
+def _batches(items):
+    items = list(items)
+    for i in range(0, len(items), UPDATE_BATCH):
+        yield items[i:i + UPDATE_BATCH]
+
+
+def _bulk_set(model, rows, audited=False):
+    """Set absolute field values, given {pk: {field: value}}
+
+    Only ``audited`` updates are logged as edits: the costs and totals the
+    engine derives from them are not.
+    """
+    if audited:
+        audit.record_many(GrainEvent.EDIT, model, rows)
+    for batch in _batches(rows.items()):
+        fields = {}
+        for pk, values in batch:
+            for field, value in values.items():
+                fields.setdefault(field, []).append(
+                    When(pk=pk, then=Value(value)))
+        model.objects.filter(pk__in=[pk for pk, _ in batch]).update(**{
+            field: Case(*whens, default=F(field),
+                        output_field=_OUTPUT_FIELDS[field])
+            for field, whens in fields.items()})
+
+
+def _bulk_adjust(model, rows):
+    """Add deltas to field values, given {pk: {field: delta}}"""
+    for batch in _batches(rows.items()):
+        fields = {}
+        for pk, deltas in batch:
+            for field, delta in deltas.items():
+                fields.setdefault(field, []).append(
+                    When(pk=pk, then=Value(delta)))
+        model.objects.filter(pk__in=[pk for pk, _ in batch]).update(**{
+            field: F(field) + Case(*whens, default=Value(Decimal(0)),
+                                   output_field=_OUTPUT_FIELDS[field])
+            for field, whens in fields.items()})
+
+
+def _nonzero(rows):
+    return {pk: {field: d for field, d in deltas.items() if d}
+            for pk, deltas in rows.items() if any(deltas.values())}
+
+
+def _adjust_meals(meals):
+    """Apply meal cost deltas, along with their spend rollups"""
+    _bulk_adjust(Meal, meals)
+    spend = SpendChanges()
+    spend.meal_deltas(meals)
+    spend.apply()
+    invalidate_meals(meals)
+
+
+class CostChanges(object):
+    """Pending cost changes to tickets, dishes and meals
+
+    Ticket changes are absolute; dish and meal changes are deltas, so that
+    concurrent writers to the same running total do not clobber each other.
+    The deltas are also kept per ticket, for the ledger.  Nothing touches
+    the database until ``apply`` is called.
+    """
+    def __init__(self):
+        self.tickets = defaultdict(dict)
+        self.dishes = defaultdict(lambda: defaultdict(Decimal))
+        self.meals = defaultdict(lambda: defaultdict(Decimal))
+        self.entries = defaultdict(Decimal)
+
+    def set_ticket(self, pk, **values):
+        self.tickets[pk].update(values)
+
+    def adjust(self, dish_pk, meal_pk, field, delta, ticket_pk=None):
+        if delta:
+            self.dishes[dish_pk][field] += delta
+            self.meals[meal_pk][field] += delta
+            self.entries[ticket_pk, dish_pk, meal_pk,
+                         field == cost_field(True)] += delta
+
+    def recost_ticket(self, pk, used, cost, dish_pk, meal_pk, cost_per_unit,
+                      final=False):
+        """Reprice a ticket; returns its new cost amount"""
+        new_cost = quantize_cost((used * cost_per_unit).amount)
+        if new_cost != cost:
+            self.set_ticket(pk, cost=new_cost)
+            self.adjust(dish_pk, meal_pk, cost_field(final), new_cost - cost,
+                        pk)
+        return new_cost
+
+    def recost(self, tickets, cost_per_unit):
+        """Reprice every ticket in a queryset in a single SELECT"""
+        rows = tickets.values_list('pk', 'used', 'cost', 'final', 'dish_id',
+                                   'dish__meal_id')
+        for pk, used, cost, final, dish_pk, meal_pk in rows:
+            assert not final, "Cannot modify finalised tickets"
+            self.recost_ticket(pk, used, cost, dish_pk, meal_pk,
+                               cost_per_unit)
+
+    def close_ticket(self, pk, cost, dish_pk, meal_pk, final):
+        """Move a ticket's cost between open and closed"""
+        amount = cost if final else -cost
+        self.set_ticket(pk, final=final)
+        self.adjust(dish_pk, meal_pk, cost_field(True), amount, pk)
+        self.adjust(dish_pk, meal_pk, cost_field(False), -amount, pk)
+
+    def close(self, tickets, final):
+        """Finalise (or reopen) every ticket in a queryset"""
+        rows = tickets.exclude(final=final).values_list(
+            'pk', 'cost', 'dish_id', 'dish__meal_id')
+        for pk, cost, dish_pk, meal_pk in rows:
+            self.close_ticket(pk, cost, dish_pk, meal_pk, final)
+
+    def apply(self):
+        meals = _nonzero(self.meals)
+        with transaction.atomic():
+            _bulk_set(Ticket, self.tickets)
+            if ledger_mode():
+                CostEntry.objects.bulk_create(
+                    CostEntry(ticket_id=ticket_pk, dish_id=dish_pk,
+                              meal_id=meal_pk, final=final, amount=amount)
+                    for (ticket_pk, dish_pk, meal_pk, final), amount
+                    in self.entries.items() if amount)
+            else:
+                _bulk_adjust(Dish, _nonzero(self.dishes))
+                _adjust_meals(meals)
+
+
+def update_usage(ingredient, delta):
+    """Record ``delta`` more units of ``ingredient`` used and reprice
+
+    Every ticket on the ingredient is repriced at the new cost per unit, and
+    the resulting dish and meal deltas are applied in bulk.  Returns the new
+    cost per unit.
+    """
+    assert not ingredient.exhausted, "Ingredient has been exhausted"
+
+    with transaction.atomic():
+        ingredient.used_amount += delta
+        cpu = cost_per_unit(ingredient.price, ingredient.used_amount)
+        changes = CostChanges()
+        changes.recost(ingredient.ticket_set.all(), cpu)
+        changes.apply()
+        ingredient.save(update_fields=['used_amount'])
+    return cpu
+
+
+def create_tickets(dish, lines, currency):
+    """Create many tickets on ``dish`` and propagate their costs once
+
+    ``lines`` is a sequence of ``(ingredient, used, exhausted)``.  Tickets
+    are inserted with ``bulk_create``; each distinct ingredient is then
+    repriced once at its combined new usage, and finalised if any of its
+    lines asked for it.  Returns the number of tickets created.
+    """
+    lines = list(lines)
+    used_by_ingredient, ingredients, exhaust = defaultdict(float), {}, set()
+    before = {}
+    for ingredient, used, exhausted in lines:
+        assert used > 0, "Must use positive quantity"
+        assert not ingredient.exhausted, "Ingredient must not be exhausted"
+        used_by_ingredient[ingredient.pk] += used
+        ingredients[ingredient.pk] = ingredient
+        before[ingredient.pk] = state(ingredient)
+        if exhausted:
+            exhaust.add(ingredient.pk)
+
+    with transaction.atomic():
+        tickets = [Ticket(ingredient=ingredient, used=used, dish=dish,
+                          cost=Money(0, currency))
+                   for ingredient, used, _ in lines]
+        Ticket.objects.bulk_create(tickets)
+        audit.record_created(Ticket, tickets, dish.ticket_set.all())
+
+        changes, cpus = CostChanges(), {}
+        for pk, ingredient in ingredients.items():
+            ingredient.used_amount += used_by_ingredient[pk]
+            cpus[pk] = cost_per_unit(ingredient.price, ingredient.used_amount)
+        for batch in _batches(ingredients):
+            rows = Ticket.objects.filter(ingredient__in=batch).values_list(
+                'pk', 'ingredient_id', 'used', 'cost', 'final', 'dish_id',
+                'dish__meal_id')
+            for pk, ingredient_pk, used, cost, final, dish_pk, meal_pk in rows:
+                assert not final, "Cannot modify finalised tickets"
+                new_cost = changes.recost_ticket(pk, used, cost, dish_pk,
+                                                 meal_pk, cpus[ingredient_pk])
+                if ingredient_pk in exhaust:
+                    changes.close_ticket(pk, new_cost, dish_pk, meal_pk, True)
+        changes.apply()
+
+        for pk in exhaust:
+            ingredients[pk].exhausted = True
+        _bulk_set(Ingredient, {pk: {'used_amount': ingredient.used_amount,
+                                    'exhausted': ingredient.exhausted}
+                               for pk, ingredient in ingredients.items()},
+                  audited=True)
+        inventory = InventoryChanges()
+        for pk, ingredient in ingredients.items():
+            inventory.change(ingredient.owner_id, ingredient.product_id,
+                             before[pk], state(ingredient))
+            remember(ingredient)
+        inventory.apply()
+        invalidate_inventory(ingredient.owner_id
+                             for ingredient in ingredients.values())
+        invalidate_expiring(ingredients[pk].owner_id for pk in exhaust)
+    return len(lines)
+
+
+def set_exhausted(ingredients, exhausted):
+    """Finalise (or reopen) many ingredients at once
+
+    Moves the cost of every affected ticket between open and closed, with
+    one aggregated update per model.  ``ingredients`` is an ``Ingredient``
+    queryset; those already in the requested state are left alone.  Returns
+    the number of ingredients changed.
+    """
+    with transaction.atomic():
+        rows = list(ingredients.exclude(exhausted=exhausted).values_list(
+            'pk', 'owner_id', 'product_id', 'amount', 'used_amount', 'price'))
+        pks = [row[0] for row in rows]
+        changes = CostChanges()
+        for batch in _batches(pks):
+            changes.close(Ticket.objects.filter(ingredient__in=batch),
+                          exhausted)
+        changes.apply()
+        _bulk_set(Ingredient, {pk: {'exhausted': exhausted} for pk in pks},
+                  audited=True)
+
+        inventory = InventoryChanges()
+        for _, owner_pk, product_pk, amount, used_amount, price in rows:
+            inventory.change(owner_pk, product_pk,
+                             (amount, used_amount, price, not exhausted),
+                             (amount, used_amount, price, exhausted))
+        inventory.apply()
+        invalidate_inventory(row[1] for row in rows)
+        invalidate_expiring(row[1] for row in rows)
+        return len(pks)
+
+
+def release_tickets(tickets):
+    """Apply the net cost changes of removing a queryset of tickets
+
+    Each ticket's cost is taken off its dish and meal, and the other tickets
+    of every affected ingredient are repriced once at the reduced usage,
+    staying open or closed as they are.  The tickets themselves are left for
+    the caller to delete.
+    """
+    with transaction.atomic():
+        rows = tickets.values_list('pk', 'ingredient_id', 'used', 'cost',
+                                   'final', 'dish_id', 'dish__meal_id')
+        changes, removed = CostChanges(), set()
+        used_by_ingredient = defaultdict(float)
+        for pk, ingredient_pk, used, cost, final, dish_pk, meal_pk in rows:
+            changes.adjust(dish_pk, meal_pk, cost_field(final), -cost, pk)
+            used_by_ingredient[ingredient_pk] += used
+            removed.add(pk)
+
+        usage, owners, inventory = {}, set(), InventoryChanges()
+        for batch in _batches(used_by_ingredient):
+            for ingredient in Ingredient.objects.filter(pk__in=batch):
+                owners.add(ingredient.owner_id)
+                before = state(ingredient)
+                used_amount = (ingredient.used_amount
+                               - used_by_ingredient[ingredient.pk])
+                usage[ingredient.pk] = (
+                    used_amount,
+                    cost_per_unit(ingredient.price, used_amount))
+                ingredient.used_amount = used_amount
+                inventory.change(ingredient.owner_id, ingredient.product_id,
+                                 before, state(ingredient))
+            rows = Ticket.objects.filter(ingredient__in=batch).values_list(
+                'pk', 'ingredient_id', 'used', 'cost', 'final', 'dish_id',
+                'dish__meal_id')
+            for pk, ingredient_pk, used, cost, final, dish_pk, meal_pk in rows:
+                if pk not in removed:
+                    changes.recost_ticket(pk, used, cost, dish_pk, meal_pk,
+                                          usage[ingredient_pk][1], final)
+
+        changes.apply()
+        _bulk_set(Ingredient, {pk: {'used_amount': used_amount}
+                               for pk, (used_amount, _) in usage.items()},
+                  audited=True)
+        inventory.apply()
+        invalidate_inventory(owners)
+
+
+def remove_tickets(tickets):
+    """Delete a queryset of tickets, applying only the net cost changes
+
+    See ``release_tickets``.  Returns the result of ``QuerySet.delete``.
+    """
+    with transaction.atomic():
+        release_tickets(tickets)
+        return models.QuerySet.delete(tickets)
+
+
+def _ledger_totals(entries):
+    """Summed entries as {dish_pk: {field: amount}}, {meal_pk: ...}"""
+    dishes = defaultdict(lambda: defaultdict(Decimal))
+    meals = defaultdict(lambda: defaultdict(Decimal))
+    for dish_pk, meal_pk, final, amount in entries.values_list(
+            'dish_id', 'meal_id', 'final').annotate(Sum('amount')):
+        dishes[dish_pk][cost_field(final)] += amount
+        meals[meal_pk][cost_field(final)] += amount
+    return dishes, meals
+
+
+def compact_ledger():
+    """Fold cost entries not yet compacted into the totals
+
+    The entries are locked and read once, summed per dish and meal, and
+    marked as compacted in the same transaction, so an entry committed
+    meanwhile is left for the next run whatever its pk.  Entries for
+    deleted dishes and meals are skipped.  Returns the number of meals
+    changed.
+    """
+    with transaction.atomic():
+        pks = []
+        dishes = defaultdict(lambda: defaultdict(Decimal))
+        meals = defaultdict(lambda: defaultdict(Decimal))
+        for pk, dish_pk, meal_pk, final, amount in \
+                CostEntry.objects.select_for_update().filter(
+                    compacted=False).values_list(
+                    'pk', 'dish_id', 'meal_id', 'final', 'amount'):
+            pks.append(pk)
+            dishes[dish_pk][cost_field(final)] += amount
+            meals[meal_pk][cost_field(final)] += amount
+        meals = _nonzero(meals)
+        _bulk_adjust(Dish, _nonzero(dishes))
+        _adjust_meals(meals)
+        for batch in _batches(pks):
+            CostEntry.objects.filter(pk__in=batch).update(compacted=True)
+        return len(meals)
+
+
+def recompute_from_ledger(meals=None):
+    """Reset dish and meal totals to the sum of all their cost entries
+
+    ``meals`` is a ``Meal`` queryset, by default every meal.  The ledger
+    has to hold the whole history, see ``open_ledger``.
+    """
+    if meals is None:
+        meals = Meal.objects.all()
+    with transaction.atomic():
+        compact_ledger()
+        meal_pks = list(meals.values_list('pk', flat=True))
+        for batch in _batches(meal_pks):
+            dishes, totals = _ledger_totals(
+                CostEntry.objects.filter(meal__in=batch))
+            zero = {'cost_open': Decimal(0), 'cost_closed': Decimal(0)}
+            _bulk_set(Dish, {
+                pk: dict(zero, **dishes.get(pk, {})) for pk in
+                Dish.objects.filter(meal__in=batch).values_list('pk',
+                                                                flat=True)})
+            _bulk_set(Meal, {pk: dict(zero, **totals.get(pk, {}))
+                             for pk in batch})
+        rebuild_rollups(set(meals.values_list('owner', flat=True)))
+        invalidate_meals(meal_pks)
+
+
+def open_ledger():
+    """Record the current cost of every ticket as an opening entry
+
+    Run once when switching ledger mode on for existing data, so that the
+    ledger holds the whole history.  The entries are already part of the
+    totals, so they are marked as compacted.
+    """
+    CostEntry.objects.bulk_create(
+        CostEntry(ticket_id=pk, dish_id=dish_pk, meal_id=meal_pk,
+                  final=final, amount=cost, compacted=True)
+        for pk, dish_pk, meal_pk, final, cost in Ticket.objects.exclude(
+            cost=0).values_list('pk', 'dish_id', 'dish__meal_id', 'final',
+                                'cost').iterator())
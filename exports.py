@@ -0,0 +1,115 @@
+"""Streaming exports of meals, dishes and tickets
+
+A profile's meals in a date range are read a page at a time, each page with
+one query joined down to ticket products and fetched with ``iterator()``;
+rows are written out as they arrive, so memory use does not grow with the
+history.  ``csv_lines`` gives one row per ticket (or per dish or meal
+without any), ``ndjson_lines`` one JSON object per meal with its dishes and
+tickets.
+"""
+import csv
+import json
+from datetime import timedelta
+
+from django.db.models import Q
+
+from .models import Dish, Meal
+
+COLUMNS = (
+    'meal', 'time', 'meal_type', 'consumer', 'meal_cost_open',
+    'meal_cost_closed', 'dish', 'method', 'dish_cost_open',
+    'dish_cost_closed', 'ticket', 'product', 'vendor', 'used', 'units',
+    'cost', 'final',
+)
+_LOOKUPS = (
+    'pk', 'time', 'meal_type', 'consumer__name', 'cost_open', 'cost_closed',
+    'dish__pk', 'dish__method', 'dish__cost_open', 'dish__cost_closed',
+    'dish__ticket__pk', 'dish__ticket__ingredient__product__name',
+    'dish__ticket__ingredient__product__vendor__name', 'dish__ticket__used',
+    'dish__ticket__ingredient__product__units__short', 'dish__ticket__cost',
+    'dish__ticket__final',
+)
+CHUNK = 500                         # meals per query
+MEAL_TYPES = dict(Meal.MEAL_CHOICES)
+METHODS = dict(Dish.COOKING_STYLES)
+
+
+def rows(profile, start=None, end=None):
+    """Flat rows of ``COLUMNS`` for meals from ``start`` to ``end``
+
+    Meals are paged ``CHUNK`` at a time on ``(time, pk)``, and each page's
+    rows are fetched with a single joined query.
+    """
+    meals = Meal.objects.filter(owner=profile).order_by('time', 'pk')
+    if start is not None:
+        meals = meals.filter(time__gte=start)
+    if end is not None:
+        meals = meals.filter(time__lt=end + timedelta(days=1))
+
+    page = meals
+    while True:
+        keys = list(page.values_list('time', 'pk')[:CHUNK])
+        if not keys:
+            return
+        joined = Meal.objects.filter(pk__in=[pk for _, pk in keys]).order_by(
+            'time', 'pk', 'dish__pk', 'dish__ticket__pk')
+        for row in joined.values_list(*_LOOKUPS).iterator():
+            row = list(row)
+            row[2] = MEAL_TYPES[row[2]]
+            if row[7] is not None:
+                row[7] = METHODS.get(row[7], row[7])
+            yield row
+        time, pk = keys[-1]
+        page = meals.filter(Q(time__gt=time) | Q(time=time, pk__gt=pk))
+
+
+class _Echo(object):
+    """File-like object handing back what ``csv.writer`` writes"""
+    def write(self, value):
+        return value
+
+
+def csv_lines(profile, start=None, end=None):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(('currency',) + COLUMNS)
+    for row in rows(profile, start, end):
+        yield writer.writerow([profile.currency] + [
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in row])
+
+
+def ndjson_lines(profile, start=None, end=None):
+    meal = dish = None
+    for row in rows(profile, start, end):
+        values = dict(zip(COLUMNS, row))
+        if meal is None or meal['pk'] != values['meal']:
+            if meal is not None:
+                yield _json(meal)
+            meal = {
+                'pk': values['meal'], 'time': values['time'].isoformat(),
+                'meal_type': values['meal_type'],
+                'consumer': values['consumer'],
+                'currency': profile.currency,
+                'cost_open': values['meal_cost_open'],
+                'cost_closed': values['meal_cost_closed'], 'dishes': [],
+            }
+            dish = None
+        if values['dish'] is not None and (dish is None or
+                                           dish['pk'] != values['dish']):
+            dish = {'pk': values['dish'], 'method': values['method'],
+                    'cost_open': values['dish_cost_open'],
+                    'cost_closed': values['dish_cost_closed'],
+                    'tickets': []}
+            meal['dishes'].append(dish)
+        if values['ticket'] is not None:
+            dish['tickets'].append({
+                'pk': values['ticket'], 'product': values['product'],
+                'vendor': values['vendor'], 'used': values['used'],
+                'units': values['units'], 'cost': values['cost'],
+                'final': values['final']})
+    if meal is not None:
+        yield _json(meal)
+
+
+def _json(meal):
+    return json.dumps(meal, default=str) + "\n"
@@ -3,9 +3,11 @@ import datetime
 from django import forms
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 from moneyed import Money
 
+from . import caching
 from .models import Consumer, Dish, Ingredient, Meal, Product, UserProfile
 
 
@@ -90,7 +92,7 @@ class DishForm(forms.ModelForm):
 
 def product_listing(currency):
     products = {}
-    for p in Product.objects.filter(price__gt=Money(0, currency)):
+    for p in caching.product_catalogue(currency):
         v = str(p.vendor) if p.vendor else "Other"
         if v not in products:
             products[v] = []
@@ -120,6 +122,31 @@ class ProductForm(forms.ModelForm):
                   'price']
 
 
+def check_purchase(product, price, amount, partial, currency):
+    """Rules for a new ingredient, shared with receipt imports
+
+    Fixed products come in their usual amount unless bought ``partial``.
+    Returns the amount to record and a list of ``(field, message)`` errors.
+    """
+    errors = []
+    if price.currency != currency:
+        errors.append(('price', "Must use same currency as profile"))
+    elif price.amount < 0:
+        errors.append(('price', "Must be positive"))
+    if product.fixed and not partial:
+        amount = product.amount
+    if amount is None:
+        errors.append(('amount', "This field is required."))
+    elif amount < 0:
+        errors.append(('amount', "Must be positive"))
+    return amount, errors
+
+
+class ReceiptForm(forms.Form):
+    receipt = forms.FileField(help_text="CSV with columns product, price, "
+                              "amount, best_before and purchase_date")
+
+
 class IngredientForm(forms.ModelForm):
     amount = forms.FloatField(required=False)
     expiry_type = forms.ChoiceField(widget=forms.RadioSelect(),
@@ -138,15 +165,13 @@ class IngredientForm(forms.ModelForm):
 
     def clean(self):
         cleaned_data = super(IngredientForm, self).clean()
-        if cleaned_data['price'].currency != \
-                self.fields['price'].initial.currency:
-            self.add_error('price', "Must use same currency as profile")
-        elif cleaned_data['price'].amount < 0:
-            self.add_error('price', "Must be positive")
-        if cleaned_data['product'].fixed and not cleaned_data['partial']:
-            self.cleaned_data['amount'] = cleaned_data['product'].amount
-        if cleaned_data['amount'] < 0:
-            self.add_error('amount', "Must be positive")
+        amount, errors = check_purchase(
+            cleaned_data['product'], cleaned_data['price'],
+            cleaned_data['amount'], cleaned_data['partial'],
+            self.fields['price'].initial.currency)
+        self.cleaned_data['amount'] = amount
+        for field, message in errors:
+            self.add_error(field, message)
 
     class Meta:
         model = Ingredient
@@ -154,18 +179,109 @@ class IngredientForm(forms.ModelForm):
                   'purchase_date']
 
 
-class TicketForm(forms.Form):
-    dish = forms.ModelChoiceField(widget=forms.HiddenInput(),
-                                  queryset=Dish.objects.all())
+def open_ingredients(profile_pk):
+    return Ingredient.objects.filter(
+        exhausted=False, owner__pk=profile_pk
+    ).order_by('product__category__name', '-used_amount')\
+     .select_related('product__vendor', 'product__units')
+
+
+def _pk(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PickedIngredientField(forms.ChoiceField):
+    """An open ingredient chosen with the picker endpoint
+
+    ``ingredients`` are the open ingredients picked anywhere in the formset,
+    by pk, loaded together; only the form's own choice is rendered.
+    """
+    def __init__(self, ingredients, picked=None, *args, **kwargs):
+        self.ingredients = ingredients
+        choices = [("", "---------")]
+        if picked in ingredients:
+            choices.append((picked, str(ingredients[picked])))
+        super(PickedIngredientField, self).__init__(choices, *args, **kwargs)
+        self.widget.attrs['data-picker-url'] = reverse(
+            'grain:ingredient_picker')
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.ingredients[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise forms.ValidationError(
+                self.error_messages['invalid_choice'], code='invalid_choice',
+                params={'value': value})
+
+    def validate(self, value):
+        forms.Field.validate(self, value)
+
+
+class TicketLineForm(forms.Form):
     ingredient = forms.ModelChoiceField(
         queryset=Ingredient.objects.filter(exhausted=False))
     units_used = forms.FloatField()
     exhausted = forms.BooleanField(required=False)
 
     def __init__(self, profile_pk=None, *args, **kwargs):
-        super(TicketForm, self).__init__(*args, **kwargs)
-        self.fields['ingredient'].queryset = Ingredient.objects.filter(
-            exhausted=False, owner__pk=profile_pk
-        ).order_by('product__category__name', '-used_amount')
+        ingredients = kwargs.pop('ingredients', None)
+        super(TicketLineForm, self).__init__(*args, **kwargs)
+        if ingredients is None:
+            self.fields['ingredient'].queryset = open_ingredients(profile_pk)
+        else:
+            self.fields['ingredient'] = PickedIngredientField(
+                ingredients, _pk(self.data.get(self.add_prefix('ingredient'))))
+
+    def clean_units_used(self):
+        if self.cleaned_data['units_used'] <= 0:
+            raise forms.ValidationError("Must use positive quantity")
+        return self.cleaned_data['units_used']
+
+
+class BaseTicketLineFormSet(forms.BaseFormSet):
+    """Ticket lines sharing one query for the ingredients they name"""
+    def __init__(self, profile_pk, *args, **kwargs):
+        super(BaseTicketLineFormSet, self).__init__(*args, **kwargs)
+        self.profile_pk = profile_pk
+        pks = {_pk(value) for key, value in self.data.items()
+               if key.startswith(self.prefix) and
+               key.endswith("-ingredient")}
+        pks.discard(None)
+        self.ingredients = {}
+        if pks:
+            self.ingredients = {
+                ingredient.pk: ingredient for ingredient in
+                open_ingredients(profile_pk).filter(pk__in=pks)}
+
+    def get_form_kwargs(self, index):
+        return {'profile_pk': self.profile_pk,
+                'ingredients': self.ingredients}
+
+
+TicketLineFormSet = forms.formset_factory(
+    TicketLineForm, formset=BaseTicketLineFormSet, extra=12)
+
+
+class TicketForm(TicketLineForm):
+    dish = forms.ModelChoiceField(widget=forms.HiddenInput(),
+                                  queryset=Dish.objects.all())
+    field_order = ['dish', 'ingredient', 'units_used', 'exhausted']
+
+    def __init__(self, profile_pk=None, *args, **kwargs):
+        super(TicketForm, self).__init__(profile_pk, *args, **kwargs)
         self.fields['dish'].queryset = Dish.objects.filter(
             meal__owner__pk=profile_pk)
+
+
+class TicketPickerForm(TicketForm):
+    """TicketForm whose ingredients are loaded by the picker endpoint"""
+    def __init__(self, profile_pk=None, *args, **kwargs):
+        super(TicketPickerForm, self).__init__(profile_pk, *args, **kwargs)
+        self.fields['ingredient'].choices = []
+        self.fields['ingredient'].widget.attrs['data-picker-url'] = \
+            reverse('grain:ingredient_picker')
@@ -0,0 +1,113 @@
+"""Per-view query and timing statistics for grain
+
+``QueryStatsMiddleware`` (in ``middleware``) measures every request to a
+``grain:`` URL and hands the numbers to ``record``, which sums them per URL
+name in this process.  Queries are also fingerprinted, with literals taken
+out, so that one statement repeated within a request, the sign of an N+1,
+shows up in the report.  ``get_report`` returns the totals, and a summary is
+logged every ``GRAIN_QUERY_STATS_INTERVAL`` seconds (300 by default).
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TOP_DUPLICATES = 5      # fingerprints kept per URL name in the report
+LOGGED_VIEWS = 5        # busiest URL names in the log line
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+_lock = threading.Lock()
+_views = {}
+_last_log = [time.time()]
+
+
+def fingerprint(sql):
+    """``sql`` with its literals, and lists of them, replaced by ``?``"""
+    return _LISTS.sub("(...)", _LITERALS.sub("?", sql))
+
+
+class ViewStats(object):
+    """Running totals for one URL name"""
+    def __init__(self):
+        self.requests = self.queries = 0
+        self.sql_ms = self.view_ms = self.render_ms = 0.0
+        self.max_queries = 0
+        # fingerprint: [requests repeating it, most repeats in one request]
+        self.duplicates = defaultdict(lambda: [0, 0])
+
+    def add(self, queries, view_ms, render_ms):
+        self.requests += 1
+        self.queries += len(queries)
+        self.max_queries = max(self.max_queries, len(queries))
+        self.sql_ms += sum(float(query['time']) for query in queries) * 1000
+        self.view_ms += view_ms
+        self.render_ms += render_ms
+        counts = Counter(fingerprint(query['sql']) for query in queries)
+        for sql, count in counts.items():
+            if count > 1:
+                duplicate = self.duplicates[sql]
+                duplicate[0] += 1
+                duplicate[1] = max(duplicate[1], count)
+
+    def as_dict(self):
+        n = self.requests
+        return {
+            'requests': n,
+            'queries': round(self.queries / float(n), 1),
+            'max_queries': self.max_queries,
+            'sql_ms': round(self.sql_ms / n, 2),
+            'view_ms': round(self.view_ms / n, 2),
+            'render_ms': round(self.render_ms / n, 2),
+            'duplicates': [
+                {'sql': sql, 'requests': requests, 'max_repeats': repeats}
+                for sql, (requests, repeats) in sorted(
+                    self.duplicates.items(),
+                    key=lambda item: (-item[1][0], -item[1][1]))[
+                    :TOP_DUPLICATES]],
+        }
+
+
+def record(name, queries, view_ms, render_ms=0.0):
+    """Add a request to the totals of URL name ``name``
+
+    ``queries`` are as in ``connection.queries``; ``render_ms`` is the part
+    of the time spent rendering a template response, after ``view_ms``.
+    """
+    with _lock:
+        _views.setdefault(name, ViewStats()).add(queries, view_ms, render_ms)
+        due = time.time() - _last_log[0] >= getattr(
+            settings, 'GRAIN_QUERY_STATS_INTERVAL', 300)
+        if due:
+            _last_log[0] = time.time()
+            summary = _summary()
+    if due:
+        logger.info("grain views: %s", summary)
+
+
+def _summary():
+    busiest = sorted(_views.items(), key=lambda item: -(
+        item[1].view_ms + item[1].render_ms))
+    return "; ".join(
+        "%s %d requests, %.1f queries, %.1f ms SQL, %.1f ms total" % (
+            name, stats.requests, stats.queries / float(stats.requests),
+            stats.sql_ms / stats.requests,
+            (stats.view_ms + stats.render_ms) / stats.requests)
+        for name, stats in busiest[:LOGGED_VIEWS])
+
+
+def get_report():
+    """Averages per URL name, with the most repeated query fingerprints"""
+    with _lock:
+        return {name: stats.as_dict() for name, stats in _views.items()}
+
+
+def reset():
+    with _lock:
+        _views.clear()
@@ -0,0 +1,240 @@
+"""Inventory levels for grain
+
+``InventorySummary`` holds one row per profile and product: units and value
+on hand across open ingredients, and how many ingredients are open or
+exhausted.  Rather than summing ingredients on every report, each change to
+an ingredient adds the difference it makes to its row.  ``rebuild``
+recomputes the rows from the ingredients, to repair any drift.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from moneyed import Money
+
+from .models import Ingredient, IngredientCategory, InventorySummary
+
+VALUE_PLACES = Decimal('0.0001')    # decimal_places of InventorySummary.value
+FIELDS = ('on_hand', 'value', 'open_count', 'exhausted_count')
+# Ingredient fields that count towards the inventory, in stored_state order
+STATE_FIELDS = ('owner', 'product', 'amount', 'used_amount', 'price',
+                'exhausted')
+INGREDIENT_FIELDS = set(STATE_FIELDS) | {'owner_id', 'product_id'}
+EXPIRY_WARNING_DAYS = 3
+
+
+def state(ingredient):
+    """The fields of an ingredient that count towards the inventory"""
+    return (ingredient.amount, ingredient.used_amount,
+            ingredient.price.amount, ingredient.exhausted)
+
+
+def stored_state(pk):
+    """``(owner_pk, product_pk) + state`` of an ingredient as saved, or None
+    """
+    return Ingredient.objects.filter(pk=pk).values_list(
+        'owner_id', 'product_id', 'amount', 'used_amount', 'price',
+        'exhausted').first()
+
+
+def remember(ingredient, update_fields=None, before=None):
+    """Note an ingredient's stored state on the instance
+
+    Called when it is loaded or saved, and whenever its row is updated
+    without saving it, so that ``saved_state`` needs no query.  After a save
+    of only ``update_fields``, the other fields keep their state ``before``.
+    """
+    if ingredient.get_deferred_fields() & INGREDIENT_FIELDS:
+        return
+    stored = (ingredient.owner_id, ingredient.product_id) + state(ingredient)
+    if update_fields is not None:
+        stored = tuple(
+            new if field in update_fields or field + '_id' in update_fields
+            else old
+            for field, new, old in zip(STATE_FIELDS, stored, before))
+    ingredient._stored_state = stored
+
+
+def saved_state(ingredient):
+    """``stored_state`` of an ingredient, from the instance if it knows it"""
+    stored = getattr(ingredient, '_stored_state', None)
+    return stored if stored is not None else stored_state(ingredient.pk)
+
+
+def saves_inventory(update_fields):
+    """Whether a save with ``update_fields`` can change the inventory"""
+    return update_fields is None or bool(INGREDIENT_FIELDS & update_fields)
+
+
+def contribution(amount, used_amount, price, exhausted):
+    """What one ingredient adds to its summary row
+
+    Returns ``(on_hand, value, open_count, exhausted_count)``; exhausted
+    ingredients count, but have nothing on hand.
+    """
+    if exhausted:
+        return 0.0, Decimal(0), 0, 1
+    on_hand = amount - used_amount
+    value = Decimal(price) * Decimal(on_hand / amount) if amount else 0
+    return on_hand, Decimal(value).quantize(VALUE_PLACES), 1, 0
+
+
+class InventoryChanges(object):
+    """Pending changes to inventory summary rows
+
+    Each change is recorded as the ingredient's state before and after; only
+    the summed differences are written, by ``apply``.
+    """
+    def __init__(self):
+        self.rows = defaultdict(lambda: [0.0, Decimal(0), 0, 0])
+
+    def change(self, owner_pk, product_pk, before=None, after=None):
+        row = self.rows[owner_pk, product_pk]
+        for sign, fields in ((-1, before), (1, after)):
+            if fields is not None:
+                for i, value in enumerate(contribution(*fields)):
+                    row[i] += sign * value
+
+    def apply(self):
+        with transaction.atomic():
+            for (owner_pk, product_pk), deltas in self.rows.items():
+                if not any(deltas):
+                    continue
+                summary = InventorySummary.objects.filter(
+                    owner_id=owner_pk, product_id=product_pk)
+                updates = {field: F(field) + delta
+                           for field, delta in zip(FIELDS, deltas)}
+                if not summary.update(**updates):
+                    InventorySummary.objects.get_or_create(
+                        owner_id=owner_pk, product_id=product_pk)
+                    summary.update(**updates)
+
+
+def summarise(ingredients):
+    """Summary rows for a queryset of ingredients, keyed by (owner, product)
+    """
+    rows = defaultdict(lambda: [0.0, Decimal(0), 0, 0])
+    for values in ingredients.values_list('owner_id', 'product_id', 'amount',
+                                          'used_amount', 'price', 'exhausted'):
+        row = rows[values[:2]]
+        for i, value in enumerate(contribution(*values[2:])):
+            row[i] += value
+    return rows
+
+
+def rebuild(owner_pks=None, commit=True):
+    """Recompute summary rows from the ingredients
+
+    Limited to the given profiles if ``owner_pks`` is set.  Returns the
+    ``(owner_pk, product_pk)`` of every row that had drifted, which are only
+    rewritten if ``commit`` is set.
+    """
+    ingredients = Ingredient.objects.all()
+    summaries = InventorySummary.objects.all()
+    if owner_pks is not None:
+        ingredients = ingredients.filter(owner__in=owner_pks)
+        summaries = summaries.filter(owner__in=owner_pks)
+
+    with transaction.atomic():
+        expected = summarise(ingredients)
+        stored = {values[:2]: values[2:] for values in
+                  summaries.values_list('owner_id', 'product_id', *FIELDS)}
+
+        drifted = []
+        for key in set(expected) | set(stored):
+            on_hand, value, open_count, exhausted_count = expected.get(
+                key, (0.0, Decimal(0), 0, 0))
+            actual = stored.get(key)
+            if actual is None or (
+                    abs(actual[0] - on_hand) > 1e-6 or
+                    abs(Decimal(actual[1]) - value) >= VALUE_PLACES or
+                    (actual[2], actual[3]) != (open_count, exhausted_count)):
+                drifted.append(key)
+
+        if commit and drifted:
+            summaries.delete()
+            InventorySummary.objects.bulk_create(
+                InventorySummary(owner_id=owner_pk, product_id=product_pk,
+                                 **dict(zip(FIELDS, row)))
+                for (owner_pk, product_pk), row in expected.items())
+    return drifted
+
+
+class Level(object):
+    """One line of the inventory report"""
+    def __init__(self, name, currency, depth=0, units=None):
+        self.name, self.depth, self.units = name, depth, units
+        self.value = Money(0, currency)
+        self.on_hand = self.open_count = self.exhausted_count = 0
+
+    def add(self, summary):
+        self.value += Money(summary.value, self.value.currency.code)
+        self.open_count += summary.open_count
+        self.exhausted_count += summary.exhausted_count
+        if self.units is not None:
+            self.on_hand += summary.on_hand
+
+
+def report(profile):
+    """Inventory levels of a profile by product, category and vendor
+
+    Categories include everything below them and are listed depth first;
+    units on hand are only totalled per product, as a category or vendor
+    mixes units.
+    """
+    currency = profile.currency
+    summaries = InventorySummary.objects.filter(owner=profile).select_related(
+        'product__vendor', 'product__units', 'product__category').order_by(
+        'product__category__path', 'product__name')
+
+    products, categories, vendors = [], {}, {}
+    for summary in summaries:
+        product = summary.product
+        level = Level(product, currency, units=product.units)
+        level.add(summary)
+        products.append(level)
+        for pk in product.category.get_ancestor_pks() + [product.category_id]:
+            categories.setdefault(pk, []).append(summary)
+        vendor = str(product.get_vendor())
+        vendors.setdefault(vendor, Level(vendor, currency)).add(summary)
+
+    category_levels = []
+
+    def walk(nodes, depth):
+        for category in nodes:
+            if category.pk in categories:
+                level = Level(category.name, currency, depth)
+                for summary in categories[category.pk]:
+                    level.add(summary)
+                category_levels.append(level)
+                walk(category.children, depth + 1)
+    walk(IngredientCategory.tree(), 0)
+
+    return {
+        'products': products,
+        'categories': category_levels,
+        'vendors': sorted(vendors.values(), key=lambda level: level.name),
+    }
+
+
+def expiring(profile_pk, today=None, days=EXPIRY_WARNING_DAYS):
+    """Open ingredients due within ``days``, soonest (or most overdue) first
+
+    Plain data, so that it can be cached and served as JSON.
+    """
+    today = today or date.today()
+    ingredients = Ingredient.objects.filter(
+        owner=profile_pk, exhausted=False,
+        best_before__lte=today + timedelta(days=days)).select_related(
+        'product__vendor', 'product__units').order_by('best_before', 'pk')
+    return [{
+        'pk': ingredient.pk,
+        'product': str(ingredient.product),
+        'best_before': ingredient.best_before,
+        'expiry_type': ingredient.get_expiry_type_display(),
+        'days': (ingredient.best_before - today).days,
+        'expired': (ingredient.expiry_type == Ingredient.EXPIRES and
+                    ingredient.best_before < today),
+    } for ingredient in ingredients]
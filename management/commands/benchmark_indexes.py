@@ -0,0 +1,98 @@
+"""Plans and timings of grain's hot queries, without and with its indexes
+
+Everything happens in one transaction that is rolled back at the end: the
+synthetic data of a ``synthetic`` size tier, dropping the composite indexes
+for the "before" run, and putting them back for the "after" run.  The
+database is left as it was.
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from moneyed import Money
+
+from grain.caching import calendar_grid
+from grain.forms import open_ingredients
+from grain.models import Ingredient, Meal, Product
+from grain.synthetic import TIERS, generate
+
+EXPLAIN = {'sqlite': "EXPLAIN QUERY PLAN ", 'postgresql': "EXPLAIN "}
+INDEXED = (Meal, Ingredient, Product)
+
+
+class Command(BaseCommand):
+    help = "Compare query plans and timings without and with grain's indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tier', choices=list(TIERS), default='large')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor not in EXPLAIN:
+            raise CommandError("Not supported on %s" % connection.vendor)
+
+        with transaction.atomic():
+            user, profiles = generate(options['seed'],
+                                      **TIERS[options['tier']])
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+            queries = self.hot_queries(profiles[0], user)
+            self.set_indexes(False)
+            self.report("Without indexes", queries, options['repeat'])
+            self.set_indexes(True)
+            self.report("With indexes", queries, options['repeat'])
+            transaction.set_rollback(True)
+
+    def hot_queries(self, profile, user):
+        first, last = calendar_grid(
+            (timezone.now() - timedelta(days=365)).date().replace(day=1))
+        return [
+            ("calendar", Meal.objects.filter(
+                owner=profile, time__gte=first, time__lt=last)),
+            ("own calendar", Meal.objects.filter(
+                consumer__actual_user=user, time__gte=first, time__lt=last,
+                cost_open__gte=Money(0, profile.currency))),
+            ("inventory", Ingredient.objects.filter(
+                owner=profile, exhausted=False).order_by('purchase_date',
+                                                         'best_before')),
+            ("ticket form", open_ingredients(profile.pk)),
+            ("product listing", Product.objects.filter(
+                price__gt=Money(0, profile.currency))),
+        ]
+
+    def set_indexes(self, present):
+        with connection.schema_editor() as editor:
+            for model in INDEXED:
+                indexes = model._meta.index_together
+                if present:
+                    editor.alter_index_together(model, [], indexes)
+                else:
+                    editor.alter_index_together(model, indexes, [])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def report(self, title, queries, repeat):
+        self.stdout.write(title)
+        for label, queryset in queries:
+            # Timed as raw SQL, so that model instantiation does not drown
+            # out the difference the indexes make
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(EXPLAIN[connection.vendor] + sql, params)
+                plan = [row[-1] for row in cursor.fetchall()]
+
+                best = None
+                for _ in range(repeat):
+                    start = time.time()
+                    cursor.execute(sql, params)
+                    rows = len(cursor.fetchall())
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min(best, elapsed)
+
+            self.stdout.write("  %s: %d rows, %.2f ms" % (label, rows,
+                                                           best * 1000))
+            for line in plan:
+                self.stdout.write("    %s" % line)
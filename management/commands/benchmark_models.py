@@ -0,0 +1,132 @@
+"""Wall time and query counts of grain's expensive operations
+
+For each size tier a synthetic dataset is generated, and every operation is
+run ``--repeat`` times, each time in a savepoint that is rolled back so that
+all runs see the same data.  The whole benchmark is rolled back at the end.
+Results are written as JSON; pass an earlier result as ``--baseline`` to
+compare against it.
+"""
+import json
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
+
+from grain.costing import set_exhausted
+from grain.models import Ingredient, Meal, Ticket
+from grain.synthetic import TIERS, generate
+from grain.templatetags.grain_extras import calendar
+
+EXHAUST_COUNT = 50
+
+
+def operations(profile):
+    """``(name, prepare, run)``; ``run`` is timed on what ``prepare`` returns
+    """
+    open_ingredients = Ingredient.objects.filter(owner=profile,
+                                                 exhausted=False)
+    staple_pk = open_ingredients.annotate(tickets=Count('ticket')).order_by(
+        '-tickets', 'pk').values_list('pk', flat=True)[0]
+    meals = Meal.objects.filter(owner=profile)
+    last_meal = meals.order_by('-time', '-pk').first()
+
+    def staple():
+        return Ingredient.objects.get(pk=staple_pk)
+
+    def render_calendar(month):
+        render_to_string('grain/cal/calendar.html', calendar(month, meals))
+
+    return [
+        ("create_ticket",
+         lambda: (staple(), last_meal.dish_set.first()),
+         lambda args: Ticket.objects.create_ticket(
+             args[0], 1.0, args[1], profile.currency)),
+        ("update_usage", staple, lambda ingredient: ingredient.update_usage(1.0)),
+        ("set_exhausted",
+         lambda: list(open_ingredients.exclude(pk=staple_pk).order_by(
+             '-purchase_date', 'pk').values_list('pk', flat=True)[
+             :EXHAUST_COUNT]),
+         lambda pks: set_exhausted(Ingredient.objects.filter(pk__in=pks),
+                                   True)),
+        ("delete_tickets",
+         lambda: Ticket.objects.filter(dish__meal=last_meal),
+         lambda tickets: tickets.delete()),
+        ("calendar",
+         lambda: date(last_meal.time.year, last_meal.time.month, 1),
+         render_calendar),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Benchmark ticket, usage and calendar operations on synthetic data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tiers', nargs='+', choices=list(TIERS),
+                            default=['small', 'medium'])
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', help="file for the JSON results")
+        parser.add_argument('--baseline',
+                            help="earlier JSON results to compare with")
+
+    def handle(self, *args, **options):
+        results = {'seed': options['seed'], 'repeat': options['repeat'],
+                   'vendor': connection.vendor, 'tiers': {}}
+        for tier in options['tiers']:
+            with transaction.atomic():
+                start = time.time()
+                _, profiles = generate(options['seed'], **TIERS[tier])
+                results['tiers'][tier] = {
+                    'sizes': TIERS[tier],
+                    'generate_s': round(time.time() - start, 3),
+                    'operations': self.run(profiles[0], options['repeat']),
+                }
+                transaction.set_rollback(True)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                self.compare(json.load(f), results)
+
+    def run(self, profile, repeat):
+        timings = {}
+        for name, prepare, run in operations(profile):
+            times = []
+            for _ in range(repeat):
+                with transaction.atomic():
+                    args = prepare()
+                    with CaptureQueriesContext(connection) as queries:
+                        start = time.time()
+                        run(args)
+                        times.append((time.time() - start) * 1000)
+                    transaction.set_rollback(True)
+            times.sort()
+            timings[name] = {'best_ms': round(times[0], 3),
+                             'median_ms': round(times[len(times) // 2], 3),
+                             'queries': len(queries)}
+        return timings
+
+    def compare(self, baseline, results):
+        for tier, result in sorted(results['tiers'].items()):
+            before = baseline.get('tiers', {}).get(tier, {}).get(
+                'operations', {})
+            for name, now in sorted(result['operations'].items()):
+                if name not in before:
+                    continue
+                was = before[name]
+                change = (now['median_ms'] / was['median_ms'] - 1) * 100 \
+                    if was['median_ms'] else 0
+                self.stderr.write("%s %s: %.2f -> %.2f ms (%+.0f%%), "
+                                  "%d -> %d queries" % (
+                                      tier, name, was['median_ms'],
+                                      now['median_ms'], change,
+                                      was['queries'], now['queries']))
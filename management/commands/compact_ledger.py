@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from grain.costing import compact_ledger, open_ledger, recompute_from_ledger
+
+
+class Command(BaseCommand):
+    help = "Fold new cost ledger entries into dish and meal totals"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--open', action='store_true',
+                            help="first record every ticket's current cost "
+                                 "as an opening entry")
+        parser.add_argument('--recompute', action='store_true',
+                            help="rebuild every total from the whole ledger")
+
+    def handle(self, *args, **options):
+        if options['open']:
+            open_ledger()
+        if options['recompute']:
+            recompute_from_ledger()
+            self.stdout.write("Recomputed all totals")
+        else:
+            self.stdout.write("%d meals updated" % compact_ledger())
@@ -0,0 +1,37 @@
+from datetime import date, timedelta
+
+from django.core.mail import send_mail
+from django.core.management.base import BaseCommand
+
+from grain.inventory import EXPIRY_WARNING_DAYS, expiring
+from grain.models import Ingredient, UserProfile
+
+
+class Command(BaseCommand):
+    help = "Daily digest of ingredients expiring soon, per profile"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=EXPIRY_WARNING_DAYS)
+        parser.add_argument('--email', action='store_true',
+                            help="mail each digest to the profile's users")
+
+    def handle(self, *args, **options):
+        due = Ingredient.objects.filter(
+            exhausted=False,
+            best_before__lte=date.today() + timedelta(days=options['days']))
+        for profile in UserProfile.objects.filter(
+                pk__in=due.values('owner')).order_by('pk'):
+            items = expiring(profile.pk, days=options['days'])
+            if not items:
+                continue
+            lines = ["%s: %s %s %s" % (profile.note, item['product'],
+                                      item['expiry_type'], item['best_before'])
+                     for item in items]
+            self.stdout.write("\n".join(lines))
+            if options['email']:
+                recipients = [user.email for user in profile.user.all()
+                              if user.email]
+                if recipients:
+                    send_mail("Grain: %d items expiring soon in %s"
+                              % (len(items), profile.note), "\n".join(lines),
+                              None, recipients)
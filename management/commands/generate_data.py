@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from grain.models import Meal, Ticket
+from grain.synthetic import TIERS, generate
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic dataset, the same for the same seed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tier', choices=list(TIERS), default='small')
+        parser.add_argument('--seed', type=int, default=0)
+        for size in TIERS['small']:
+            parser.add_argument('--%s' % size, type=int,
+                                help="override the tier's number of %s"
+                                     % size)
+
+    def handle(self, *args, **options):
+        sizes = dict(TIERS[options['tier']])
+        sizes.update((size, options[size]) for size in sizes
+                     if options[size] is not None)
+        user, profiles = generate(options['seed'], **sizes)
+        for profile in profiles:
+            self.stdout.write("%s: %d meals, %d tickets" % (
+                profile, Meal.objects.filter(owner=profile).count(),
+                Ticket.objects.filter(ingredient__owner=profile).count()))
+        self.stdout.write("Log in as %s to browse them" % user)
@@ -0,0 +1,30 @@
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from grain.models import UserProfile
+from grain.receipts import import_receipt
+
+
+class Command(BaseCommand):
+    help = "Add the purchases in a CSV receipt to a profile's inventory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('profile', type=int, help="profile primary key")
+        parser.add_argument('receipt', help="CSV file")
+
+    def handle(self, *args, **options):
+        try:
+            profile = UserProfile.objects.get(pk=options['profile'])
+        except UserProfile.DoesNotExist:
+            raise CommandError("No profile %d" % options['profile'])
+        with io.open(options['receipt'], encoding='utf-8-sig',
+                     newline='') as receipt:
+            try:
+                created, errors = import_receipt(profile, receipt)
+            except UnicodeDecodeError:
+                raise CommandError("Not a UTF-8 text file; nothing imported")
+        for line, message in errors:
+            self.stderr.write("line %d: %s" % (line, message))
+        self.stdout.write("%d items imported, %d rows skipped"
+                          % (created, len(errors)))
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from grain.audit import archive, compact
+
+
+class Command(BaseCommand):
+    help = "Compact old audit events and archive the oldest to disk"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--compact-after', type=int, metavar='DAYS',
+            default=getattr(settings, 'GRAIN_EVENT_COMPACT_DAYS', 30),
+            help="keep one edit per object and day in older events")
+        parser.add_argument(
+            '--archive-after', type=int, metavar='DAYS',
+            default=getattr(settings, 'GRAIN_EVENT_RETENTION_DAYS', 365),
+            help="move older events to an archive file")
+        parser.add_argument(
+            '--directory',
+            default=getattr(settings, 'GRAIN_EVENT_ARCHIVE_DIR', '.'),
+            help="where to write archive files")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        removed = compact(now - timedelta(days=options['compact_after']))
+        self.stdout.write("%d repeated edits removed" % removed)
+        archived = archive(now - timedelta(days=options['archive_after']),
+                           options['directory'])
+        if archived:
+            self.stdout.write("%d events archived to %s" % archived[::-1])
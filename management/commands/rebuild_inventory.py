@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from grain.inventory import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recompute inventory summaries from ingredients, repairing drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', type=int, action='append',
+                            dest='profiles', metavar='PK',
+                            help="only this profile (may be repeated)")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="report drift without repairing it")
+
+    def handle(self, *args, **options):
+        drifted = rebuild(options['profiles'],
+                          commit=not options['dry_run'])
+        for owner_pk, product_pk in sorted(drifted):
+            self.stdout.write("profile %s, product %s: drifted"
+                              % (owner_pk, product_pk))
+        self.stdout.write("%d summaries %s" % (
+            len(drifted), "drifted" if options['dry_run'] else "repaired"))
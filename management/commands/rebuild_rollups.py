@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from grain.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recompute spend rollups from meals"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', type=int, action='append',
+                            dest='profiles', metavar='PK',
+                            help="only this profile (may be repeated)")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d rollups written" % rebuild(options['profiles']))
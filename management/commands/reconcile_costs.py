@@ -0,0 +1,78 @@
+from functools import partial
+from multiprocessing import Pool
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from grain.costing import ledger_mode
+from grain.models import UserProfile
+from grain.reconcile import reconcile
+
+
+def _start_worker():
+    django.setup()
+    # Never share the parent's database connections
+    connections.close_all()
+
+
+def _reconcile(repair, profile_pk):
+    return profile_pk, reconcile(profile_pk, repair)
+
+
+class Command(BaseCommand):
+    help = "Recompute ticket, dish and meal costs and report any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('profiles', nargs='*', type=int,
+                            help="profile primary keys (default: all)")
+        parser.add_argument('--repair', action='store_true',
+                            help="rewrite drifted costs")
+        parser.add_argument('--processes', type=int, default=1,
+                            help="profiles reconciled in parallel")
+
+    def handle(self, *args, **options):
+        if ledger_mode():
+            raise CommandError("Totals lag behind the ledger; use "
+                               "compact_ledger --recompute instead")
+        if (options['repair'] and options['processes'] > 1 and
+                connection.vendor == 'sqlite'):
+            raise CommandError("SQLite allows a single writer; repair "
+                               "without --processes")
+        profile_pks = options['profiles'] or list(
+            UserProfile.objects.order_by('pk').values_list('pk', flat=True))
+        work = partial(_reconcile, options['repair'])
+
+        if options['processes'] > 1:
+            connections.close_all()
+            pool = Pool(options['processes'], initializer=_start_worker)
+            try:
+                results = pool.imap_unordered(work, profile_pks)
+                totals = self.report(results, options)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            totals = self.report(map(work, profile_pks), options)
+
+        self.stdout.write("%d tickets, %d dishes and %d meals %s" % (
+            totals['tickets'], totals['dishes'], totals['meals'],
+            "repaired" if options['repair'] else "drifted"))
+
+    def report(self, results, options):
+        totals = {'tickets': 0, 'dishes': 0, 'meals': 0}
+        for profile_pk, result in results:
+            for name in totals:
+                totals[name] += result[name]
+            if any(result[name] for name in totals):
+                self.stdout.write(
+                    "profile %d: %d tickets, %d dishes, %d meals" % (
+                        profile_pk, result['tickets'], result['dishes'],
+                        result['meals']))
+                if options['verbosity'] > 1:
+                    for name, pk, expected in result['samples']:
+                        self.stdout.write("  %s %d should be %s" % (
+                            name, pk, ", ".join(
+                                "%s=%s" % item
+                                for item in sorted(expected.items()))))
+        return totals
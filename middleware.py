@@ -0,0 +1,90 @@
+import time
+
+from django.db import connection
+from django.shortcuts import get_object_or_404
+from django.utils.functional import SimpleLazyObject
+
+from . import audit, instrumentation
+from .models import UserProfile
+
+
+def user_profiles(user):
+    if not user.is_authenticated:
+        return []
+    return list(UserProfile.objects.filter(user=user).order_by('pk'))
+
+
+def active_profile(request, pk):
+    for profile in request.grain_profiles:
+        if profile.pk == pk:
+            return profile
+    return get_object_or_404(UserProfile, pk=pk)
+
+
+class ProfileMiddleware(object):
+    """Resolve the active profile and the user's profiles once per request
+
+    ``request.grain_profiles`` lists the user's profiles, and
+    ``request.grain_profile`` is the selected one (or None).  Both are lazy,
+    and the active profile is normally found in the list, so a page showing
+    both costs a single query.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.grain_profiles = SimpleLazyObject(
+            lambda: user_profiles(request.user))
+        pk = request.session.get('grain_active_user_profile')
+        request.grain_profile = SimpleLazyObject(
+            lambda: active_profile(request, pk)) if pk else None
+        return self.get_response(request)
+
+
+class AuditMiddleware(object):
+    """Attribute audit events to the request's user
+
+    Events committed while the request is handled are written in one batch
+    once the response is ready.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with audit.request_scope(request.user):
+            return self.get_response(request)
+
+
+class QueryStatsMiddleware(object):
+    """Measure queries and time spent on each ``grain:`` URL
+
+    Opt-in, as it records every query of a request, like ``DEBUG`` does.
+    Template responses are timed separately from the view that built them.
+    See ``instrumentation`` for the report.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        first = len(connection.queries_log)
+        start = time.time()
+        try:
+            response = self.get_response(request)
+            end = time.time()
+            queries = connection.queries[first:]
+        finally:
+            connection.force_debug_cursor = debug_cursor
+
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and 'grain' in match.namespaces:
+            rendered = getattr(request, 'grain_view_done', end)
+            instrumentation.record(match.view_name, queries,
+                                   (rendered - start) * 1000,
+                                   (end - rendered) * 1000)
+        return response
+
+    def process_template_response(self, request, response):
+        request.grain_view_done = time.time()
+        return response
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def build_paths(apps, schema_editor):
+    IngredientCategory = apps.get_model('grain', 'IngredientCategory')
+    parents = dict(IngredientCategory.objects.values_list('pk', 'parent_id'))
+    paths = {}
+
+    def path(pk):
+        if pk not in paths:
+            parent = parents[pk]
+            paths[pk] = "%s%06d/" % (path(parent) if parent else "", pk)
+        return paths[pk]
+
+    for pk in parents:
+        IngredientCategory.objects.filter(pk=pk).update(path=path(pk))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0008_auto_20161019_1137'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredientcategory',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
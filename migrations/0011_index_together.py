@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 15:48
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0010_product_updated'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ingredient',
+            index_together=set([('owner', 'exhausted', 'purchase_date', 'best_before')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='meal',
+            index_together=set([('owner', 'time'), ('consumer', 'time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='product',
+            index_together=set([('price_currency', 'price')]),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 16:31
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    Ingredient = apps.get_model('grain', 'Ingredient')
+    InventorySummary = apps.get_model('grain', 'InventorySummary')
+    rows = defaultdict(lambda: [0.0, Decimal(0), 0, 0])
+    for owner, product, amount, used_amount, price, exhausted in \
+            Ingredient.objects.values_list('owner_id', 'product_id', 'amount',
+                                           'used_amount', 'price', 'exhausted'):
+        row = rows[owner, product]
+        if exhausted:
+            row[3] += 1
+        else:
+            row[0] += amount - used_amount
+            if amount:
+                row[1] += (Decimal(price) * Decimal((amount - used_amount)
+                                                    / amount)).quantize(
+                    Decimal('0.0001'))
+            row[2] += 1
+    InventorySummary.objects.bulk_create(
+        InventorySummary(owner_id=owner, product_id=product, on_hand=on_hand,
+                         value=value, open_count=open_count,
+                         exhausted_count=exhausted_count)
+        for (owner, product), (on_hand, value, open_count, exhausted_count)
+        in rows.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0011_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventorySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('on_hand', models.FloatField(default=0)),
+                ('value', models.DecimalField(decimal_places=4, default=0, max_digits=12)),
+                ('open_count', models.IntegerField(default=0)),
+                ('exhausted_count', models.IntegerField(default=0)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='grain.UserProfile')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='grain.Product')),
+            ],
+            options={
+                'verbose_name_plural': 'inventory summaries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='inventorysummary',
+            unique_together=set([('owner', 'product')]),
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 17:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0012_inventorysummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CostCompaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_entry', models.IntegerField()),
+                ('time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CostEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=10)),
+                ('final', models.BooleanField()),
+                ('time', models.DateTimeField(auto_now_add=True)),
+                ('dish', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, to='grain.Dish')),
+                ('meal', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, to='grain.Meal')),
+                ('ticket', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='grain.Ticket')),
+            ],
+            options={
+                'verbose_name_plural': 'cost entries',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='costentry',
+            index_together=set([('dish', 'final'), ('meal', 'final')]),
+        ),
+    ]
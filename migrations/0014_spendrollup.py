@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 17:54
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def build_rollups(apps, schema_editor):
+    Meal = apps.get_model('grain', 'Meal')
+    SpendRollup = apps.get_model('grain', 'SpendRollup')
+    rows = defaultdict(lambda: [Decimal(0), Decimal(0), 0])
+    for owner, consumer, meal_type, time, cost_open, cost_closed in \
+            Meal.objects.values_list('owner_id', 'consumer_id', 'meal_type',
+                                     'time', 'cost_open', 'cost_closed'
+                                     ).iterator():
+        if timezone.is_aware(time):
+            time = timezone.localtime(time)
+        day = time.date()
+        for period, start in (('week', day - timedelta(days=day.weekday())),
+                              ('month', day.replace(day=1))):
+            row = rows[owner, consumer, meal_type, period, start]
+            row[0] += cost_open
+            row[1] += cost_closed
+            row[2] += 1
+    SpendRollup.objects.bulk_create(
+        SpendRollup(owner_id=key[0], consumer_id=key[1], meal_type=key[2],
+                    period=key[3], start=key[4], cost_open=row[0],
+                    cost_closed=row[1], meals=row[2])
+        for key, row in rows.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0013_costentry_costcompaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('meal_type', models.IntegerField(choices=[(0, 'Breakfast'), (1, 'Lunch'), (2, 'Dinner'), (3, 'Supper'), (4, 'Tea'), (5, 'Snack')])),
+                ('period', models.CharField(choices=[('week', 'Weekly'), ('month', 'Monthly')], max_length=5)),
+                ('start', models.DateField()),
+                ('cost_open', models.DecimalField(decimal_places=4, default=0, max_digits=12)),
+                ('cost_closed', models.DecimalField(decimal_places=4, default=0, max_digits=12)),
+                ('meals', models.IntegerField(default=0)),
+                ('consumer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='grain.Consumer')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='grain.UserProfile')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='spendrollup',
+            unique_together=set([('owner', 'consumer', 'meal_type', 'period', 'start')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='spendrollup',
+            index_together=set([('owner', 'period', 'start')]),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 18:20
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0014_spendrollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ingredient',
+            index_together=set([('owner', 'exhausted', 'best_before'), ('owner', 'exhausted', 'purchase_date', 'best_before')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0016_grainevent_user_null'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='grainevent',
+            name='time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='grainevent',
+            index_together=set([('model', 'object_pk', 'time')]),
+        ),
+    ]
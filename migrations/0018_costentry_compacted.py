@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_compacted(apps, schema_editor):
+    CostCompaction = apps.get_model('grain', 'CostCompaction')
+    CostEntry = apps.get_model('grain', 'CostEntry')
+    last = CostCompaction.objects.aggregate(
+        end=models.Max('last_entry'))['end']
+    if last is not None:
+        CostEntry.objects.filter(pk__lte=last).update(compacted=True)
+
+
+def mark_watermark(apps, schema_editor):
+    CostCompaction = apps.get_model('grain', 'CostCompaction')
+    CostEntry = apps.get_model('grain', 'CostEntry')
+    last = CostEntry.objects.filter(compacted=True).aggregate(
+        end=models.Max('pk'))['end']
+    if last is not None:
+        CostCompaction.objects.create(last_entry=last)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('grain', '0017_grainevent_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='costentry',
+            name='compacted',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(mark_compacted, mark_watermark),
+        migrations.DeleteModel(
+            name='CostCompaction',
+        ),
+    ]
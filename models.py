@@ -2,9 +2,12 @@ from datetime import date
 from decimal import Decimal
 
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import signals
+from django.core.exceptions import ValidationError
+from django.db import models, router, transaction
+from django.db.models import Value, signals
+from django.db.models.functions import Concat, Substr
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from djmoney.models.fields import CurrencyField, MoneyField
 from moneyed import Money
@@ -22,12 +25,22 @@ class GrainEvent(models.Model):
     action = models.CharField(choices=LOG_ACTIONS, max_length=20)
     model = models.CharField(max_length=30)
     object_pk = models.IntegerField()
-    user = models.ForeignKey(User)
-    time = models.DateField(auto_now_add=True)
+    user = models.ForeignKey(User, null=True, blank=True)
+    time = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        index_together = [('model', 'object_pk', 'time')]
 
     def __str__(self):
         return "%s %s (%s)" % (self.model, self.action, self.user)
 
+    @classmethod
+    def history(cls, instance):
+        """Events of one object, newest first"""
+        return cls.objects.filter(
+            model=type(instance).__name__,
+            object_pk=instance.pk).order_by('-time', '-pk')
+
 
 @python_2_unicode_compatible
 class UserProfile(models.Model):
@@ -69,14 +82,91 @@ class Unit(models.Model):
 
 @python_2_unicode_compatible
 class IngredientCategory(models.Model):
-    """Cascading categories for ingredients"""
+    """Cascading categories for ingredients
+
+    ``path`` materialises the hierarchy as the zero-padded primary keys of
+    the category's ancestors and itself, e.g. ``000001/000004/``.  It is
+    maintained on save, so subtrees are a single prefix filter and ancestor
+    chains a single primary key lookup.
+    """
     parent = models.ForeignKey('self', default=None, blank=True, null=True)
     name = models.CharField(max_length=40)
+    path = models.CharField(max_length=255, db_index=True, editable=False,
+                            default="")
+
+    def build_path(self):
+        parent_path = self.parent.path if self.parent else ""
+        return "%s%06d/" % (parent_path, self.pk)
+
+    def clean(self):
+        if self.pk and self.parent and self.parent.path.startswith(self.path):
+            raise ValidationError({'parent': "Category can't be its own "
+                                             "ancestor"})
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super(IngredientCategory, self).save(*args, **kwargs)
+            old_path, self.path = self.path, self.build_path()
+            if old_path == self.path:
+                return
+            IngredientCategory.objects.filter(pk=self.pk).update(
+                path=self.path)
+            if old_path:
+                IngredientCategory.objects.filter(
+                    path__startswith=old_path).exclude(pk=self.pk).update(
+                    path=Concat(Value(self.path),
+                                Substr('path', len(old_path) + 1)))
+
+    def get_ancestor_pks(self):
+        return [int(pk) for pk in self.path.split("/") if pk][:-1]
+
+    def get_ancestors(self):
+        return IngredientCategory.objects.filter(
+            pk__in=self.get_ancestor_pks()).order_by('path')
+
+    def get_descendants(self, include_self=False):
+        descendants = IngredientCategory.objects.filter(
+            path__startswith=self.path)
+        return descendants if include_self else descendants.exclude(
+            pk=self.pk)
+
+    def get_ingredients(self):
+        """All ingredients in this category or any below it"""
+        return Ingredient.objects.filter(
+            product__category__path__startswith=self.path)
 
     def get_parent_name_list(self):
-        li = self.parent.get_parent_name_list() if self.parent else []
-        li.append(self.name)
-        return li
+        if not hasattr(self, '_parent_names'):
+            self._parent_names = [c.name for c in self.get_ancestors()]
+            self._parent_names.append(self.name)
+        return list(self._parent_names)
+
+    @classmethod
+    def prefetch_parent_names(cls, categories):
+        """Fill in get_parent_name_list for many categories in one query"""
+        categories = list(categories)
+        names = dict(cls.objects.filter(pk__in={
+            pk for category in categories
+            for pk in category.get_ancestor_pks()}).values_list('pk', 'name'))
+        for category in categories:
+            category._parent_names = [
+                names[pk] for pk in category.get_ancestor_pks()]
+            category._parent_names.append(category.name)
+
+    @classmethod
+    def tree(cls, categories=None):
+        """Root categories with their ``children`` attached, in one query"""
+        if categories is None:
+            categories = cls.objects.all()
+        nodes, roots = {}, []
+        for category in categories.order_by('path'):
+            category.children = []
+            nodes[category.pk] = category
+            if category.parent_id in nodes:
+                nodes[category.parent_id].children.append(category)
+            else:
+                roots.append(category)
+        return roots
 
     class Meta:
         verbose_name_plural = "ingredient categories"
@@ -103,6 +193,7 @@ class Product(models.Model):
     amount = models.FloatField()
     units = models.ForeignKey(Unit)
     fixed = models.BooleanField(default=True)
+    updated = models.DateTimeField(auto_now=True, editable=False)
 
     def get_vendor(self):
         return self.vendor if self.vendor else "Other"
@@ -113,6 +204,10 @@ class Product(models.Model):
         return "%s %s (%g%s)" % (self.get_vendor(), self.name, self.amount,
                                  self.units)
 
+    class Meta:
+        # product_listing: products priced in one currency
+        index_together = [('price_currency', 'price')]
+
 
 @python_2_unicode_compatible
 class Ingredient(models.Model):
@@ -133,25 +228,32 @@ class Ingredient(models.Model):
     purchase_date = models.DateField(default=date.today)
     exhausted = models.BooleanField(default=False)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        from .inventory import remember
+        ingredient = super(Ingredient, cls).from_db(db, field_names, values)
+        remember(ingredient)
+        return ingredient
+
     def update_usage(self, delta):
-        assert not self.exhausted, "Ingredient has been exhausted"
-
-        self.used_amount += delta
-        if self.used_amount != 0:
-            cpu = self.price * (1 / self.used_amount)
-        else:
-            cpu = Money(0, self.price.currency.code)
-        for ticket in self.ticket_set.all():
-            ticket.update_cost(cpu)
-        self.save()
-        return cpu
+        from .costing import update_usage
+        return update_usage(self, delta)
 
     def set_exhausted(self, exhausted):
+        from .costing import set_exhausted
+        from .inventory import remember
         if exhausted != self.exhausted:
-            for ticket in self.ticket_set.all():
-                ticket.set_final(exhausted)
+            set_exhausted(Ingredient.objects.filter(pk=self.pk), exhausted)
             self.exhausted = exhausted
-            self.save()
+            remember(self)
+
+    class Meta:
+        # The open inventory, in the order it is listed; its prefix also
+        # serves the ticket form's open ingredients.  Then open ingredients
+        # by due date, for expiry alerts.
+        index_together = [('owner', 'exhausted', 'purchase_date',
+                           'best_before'),
+                          ('owner', 'exhausted', 'best_before')]
 
     def __str__(self):
         return "%s %s (%g %s:%s)" % (self.product.get_vendor(),
@@ -159,6 +261,32 @@ class Ingredient(models.Model):
                                      self.product.units, self.used_amount)
 
 
+class InventorySummary(models.Model):
+    """Inventory levels of a product within a profile, see ``inventory``"""
+    owner = models.ForeignKey(UserProfile)
+    product = models.ForeignKey(Product)
+    on_hand = models.FloatField(default=0)
+    value = models.DecimalField(max_digits=12, decimal_places=4, default=0)
+    open_count = models.IntegerField(default=0)
+    exhausted_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('owner', 'product')]
+        verbose_name_plural = "inventory summaries"
+
+
+class MealQuerySet(models.QuerySet):
+    def with_dishes(self):
+        """Prefetch consumers, dishes and tickets down to ticket labels"""
+        return self.select_related('consumer').prefetch_related(
+            models.Prefetch('dish_set', queryset=Dish.objects.order_by(
+                '-cost_closed', '-cost_open', 'id')),
+            models.Prefetch('dish_set__ticket_set',
+                            queryset=Ticket.objects.select_related(
+                                'ingredient__product__vendor',
+                                'ingredient__product__units')))
+
+
 @python_2_unicode_compatible
 class Meal(models.Model):
     # FIXME: include docstring
@@ -178,6 +306,20 @@ class Meal(models.Model):
     cost_open = MoneyField(max_digits=10, decimal_places=4)
     consumer = models.ForeignKey(Consumer)
 
+    objects = MealQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        meal = super(Meal, cls).from_db(db, field_names, values)
+        # Where the calendar shows the meal, to tell on save if it moved
+        if not meal.get_deferred_fields() & {'time', 'owner_id',
+                                             'consumer_id'}:
+            meal._calendar_place = meal.calendar_place()
+        return meal
+
+    def calendar_place(self):
+        return self.time, self.owner_id, self.consumer_id
+
     def cost_progress_breakdown(self):
         cost_tot, pc_closed, pc_open = self.cost_closed + self.cost_open, 0, 0
         if cost_tot:
@@ -185,6 +327,15 @@ class Meal(models.Model):
             pc_open = 100 * self.cost_open.amount / cost_tot.amount
         return (cost_tot, pc_closed, pc_open)
 
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            Ticket.objects.filter(dish__meal=self).delete()
+            return super(Meal, self).delete(*args, **kwargs)
+
+    class Meta:
+        # Profile and personal calendars: one owner or consumer, by date
+        index_together = [('owner', 'time'), ('consumer', 'time')]
+
     def __str__(self):
         return "%s on %s" % (self.get_meal_type_display(), self.time.strftime("%F"))
 
@@ -207,36 +358,46 @@ class Dish(models.Model):
     cost_open = MoneyField(max_digits=10, decimal_places=4)
 
     def costs_open_change(self, delta):
+        from .costing import CostChanges, quantize_cost
+        changes = CostChanges()
+        changes.adjust(self.pk, self.meal_id, 'cost_open',
+                       quantize_cost(delta.amount))
+        changes.apply()
         self.cost_open += delta
-        self.save()
-
-        self.meal.cost_open += delta
-        self.meal.save()
 
     def costs_close(self, delta):
+        from .costing import CostChanges, quantize_cost
+        changes = CostChanges()
+        changes.adjust(self.pk, self.meal_id, 'cost_closed',
+                       quantize_cost(delta.amount))
+        changes.adjust(self.pk, self.meal_id, 'cost_open',
+                       -quantize_cost(delta.amount))
+        changes.apply()
         self.cost_closed += delta
         self.cost_open -= delta
-        self.save()
-
-        self.meal.cost_closed += delta
-        self.meal.cost_open -= delta
-        self.meal.save()
-
-    def get_ticket_form(self, profile_pk=None):
-        from .forms import TicketForm
-        return TicketForm(profile_pk, initial={'dish': self})
 
     class Meta:
         verbose_name_plural = "dishes"
 
     def __str__(self):
-        tickets = self.ticket_set.all().order_by('-cost')
-        if tickets.distinct().count() == 0:
+        # Sorted in Python so that prefetched tickets are used as they are
+        tickets = sorted(self.ticket_set.all(), key=lambda t: t.cost.amount,
+                         reverse=True)
+        if not tickets:
             return "%s (empty)" % self.method
         return "%s %s" % (self.get_method_display(), tickets[0])
 
 
+class TicketQuerySet(models.QuerySet):
+    def delete(self):
+        from .costing import remove_tickets
+        return remove_tickets(self)
+
+
 class TicketManager(models.Manager):
+    def get_queryset(self):
+        return TicketQuerySet(self.model, using=self._db)
+
     def create_ticket(self, ingredient, used_on_ticket, dish, currency,
                       exhausted=False):
         assert used_on_ticket > 0, "Must use positive quantity"
@@ -249,6 +410,10 @@ class TicketManager(models.Manager):
             ingredient.set_exhausted(True)
         return ticket
 
+    def create_tickets(self, dish, lines, currency):
+        from .costing import create_tickets
+        return create_tickets(dish, lines, currency)
+
 
 @python_2_unicode_compatible
 class Ticket(models.Model):
@@ -267,35 +432,230 @@ class Ticket(models.Model):
         self.ingredient.update_usage(delta)
 
     def update_cost(self, cost_per_unit):
+        from .costing import CostChanges
         assert not self.final, "Cannot modify finalised tickets"
-        new_cost = self.used * cost_per_unit
-        self.dish.costs_open_change(new_cost - self.cost)
-        self.cost = new_cost
-        self.save()
+        changes = CostChanges()
+        new_cost = changes.recost_ticket(self.pk, self.used, self.cost.amount,
+                                         self.dish_id, self.dish.meal_id,
+                                         cost_per_unit)
+        changes.apply()
+        self.cost = Money(new_cost, self.cost.currency)
 
     def set_final(self, final):
+        from .costing import CostChanges
         if final != self.final:
-            if final:
-                self.dish.costs_close(self.cost)
-            else:
-                self.dish.costs_close(-self.cost)
+            changes = CostChanges()
+            changes.close_ticket(self.pk, self.cost.amount, self.dish_id,
+                                 self.dish.meal_id, final)
+            changes.apply()
             self.final = final
-            self.save()
+
+    def delete(self, using=None, keep_parents=False):
+        # Through the queryset, for its cost changes; a ticket has no parents
+        using = using or router.db_for_write(Ticket, instance=self)
+        return Ticket.objects.using(using).filter(pk=self.pk).delete()
 
     def __str__(self):
         return "%s [%s]" % (self.ingredient, self.used)
 
 
-@receiver(signals.pre_delete, sender=Ticket)
-def clean_ticket(sender, **kwargs):
-    ticket = kwargs.get('instance')
-    was_final = ticket.final
+@python_2_unicode_compatible
+class CostEntry(models.Model):
+    """A change to a ticket's cost, in ledger mode (see ``costing``)
+
+    Entries are never deleted, and outlive the tickets, dishes and meals
+    they refer to.  ``compacted`` marks those already in the totals.
+    """
+    ticket = models.ForeignKey(Ticket, null=True, db_constraint=False,
+                               on_delete=models.DO_NOTHING)
+    dish = models.ForeignKey(Dish, db_constraint=False, db_index=False,
+                             on_delete=models.DO_NOTHING)
+    meal = models.ForeignKey(Meal, db_constraint=False, db_index=False,
+                             on_delete=models.DO_NOTHING)
+    amount = models.DecimalField(max_digits=10, decimal_places=4)
+    final = models.BooleanField()
+    time = models.DateTimeField(auto_now_add=True)
+    compacted = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        index_together = [('meal', 'final'), ('dish', 'final')]
+        verbose_name_plural = "cost entries"
+
+    def __str__(self):
+        return "%s %+f (%s)" % (self.ticket_id, self.amount,
+                                "closed" if self.final else "open")
 
-    if was_final:
-        ticket.ingredient.set_exhausted(False)
-        ticket.final = False
 
-    ticket.update_usage(-ticket.used)
+class SpendRollup(models.Model):
+    """Meal costs per consumer, meal type and week or month, see ``rollups``
+    """
+    WEEK, MONTH = "week", "month"
+    PERIODS = (
+        (WEEK, "Weekly"),
+        (MONTH, "Monthly"),
+    )
+
+    owner = models.ForeignKey(UserProfile)
+    consumer = models.ForeignKey(Consumer)
+    meal_type = models.IntegerField(choices=Meal.MEAL_CHOICES)
+    period = models.CharField(max_length=5, choices=PERIODS)
+    start = models.DateField()
+    cost_open = models.DecimalField(max_digits=12, decimal_places=4,
+                                    default=0)
+    cost_closed = models.DecimalField(max_digits=12, decimal_places=4,
+                                      default=0)
+    meals = models.IntegerField(default=0)
 
-    if was_final:
-        ticket.ingredient.set_exhausted(True)
+    class Meta:
+        unique_together = [('owner', 'consumer', 'meal_type', 'period',
+                            'start')]
+        index_together = [('owner', 'period', 'start')]
+
+
+@receiver(signals.pre_save, sender=Meal)
+def uncache_meal(sender, **kwargs):
+    # Covers the old date and consumer of a meal that moved; the new ones
+    # are covered after saving
+    from .caching import invalidate_meals
+    instance = kwargs.get('instance')
+    if not instance.pk or getattr(instance, '_calendar_place',
+                                  None) == instance.calendar_place():
+        return
+    invalidate_meals([instance.pk])
+
+
+@receiver(signals.post_save, sender=Meal)
+def meal_placed(sender, **kwargs):
+    instance = kwargs.get('instance')
+    if kwargs.get('update_fields') is None:
+        instance._calendar_place = instance.calendar_place()
+    else:
+        instance.__dict__.pop('_calendar_place', None)
+
+
+@receiver(signals.post_save, sender=Meal)
+@receiver(signals.post_delete, sender=Meal)
+def uncache_meal_instance(sender, **kwargs):
+    from .caching import invalidate_calendar
+    meal = kwargs.get('instance')
+    args = (meal.time, meal.owner_id, meal.cost_closed.currency.code)
+    consumer_pk = meal.consumer_id
+
+    def invalidate():
+        # Only the consumer's user is needed, not the whole consumer
+        user_pk = Consumer.objects.filter(pk=consumer_pk).values_list(
+            'actual_user_id', flat=True).first()
+        invalidate_calendar(*args, user_pk=user_pk)
+    transaction.on_commit(invalidate)
+
+
+@receiver(signals.post_save, sender=Consumer)
+def uncache_consumer(sender, **kwargs):
+    # Calendar feeds show consumer names
+    from .caching import invalidate_consumer
+    if not kwargs.get('created') and not kwargs.get('raw'):
+        invalidate_consumer(kwargs.get('instance').pk)
+
+
+@receiver(signals.post_save, sender=Ingredient)
+@receiver(signals.post_delete, sender=Ingredient)
+def uncache_inventory(sender, **kwargs):
+    from .caching import invalidate_expiring, invalidate_inventory
+    owner_pk = kwargs.get('instance').owner_id
+    invalidate_inventory([owner_pk])
+    # Usage updates save only used_amount, which expiry alerts do not show
+    if kwargs.get('update_fields') != {'used_amount'}:
+        invalidate_expiring([owner_pk])
+
+
+@receiver(signals.post_save, sender=Product)
+@receiver(signals.post_delete, sender=Product)
+@receiver(signals.post_save, sender=Vendor)
+@receiver(signals.post_delete, sender=Vendor)
+@receiver(signals.post_save, sender=Unit)
+@receiver(signals.post_save, sender=IngredientCategory)
+def uncache_catalogue(sender, **kwargs):
+    from .caching import invalidate_catalogue
+    invalidate_catalogue()
+
+
+@receiver(signals.post_save, sender=Unit)
+def touch_unit_products(sender, instance, **kwargs):
+    # Product lookups show the units, so their validators must change too
+    instance.product_set.update(updated=timezone.now())
+
+
+@receiver(signals.pre_delete, sender=Dish)
+@receiver(signals.pre_delete, sender=Ingredient)
+def clean_tickets(sender, **kwargs):
+    # The cascade deletes the tickets; only their costs and usage are undone
+    from .costing import release_tickets
+    release_tickets(kwargs.get('instance').ticket_set.all())
+
+
+@receiver(signals.pre_save, sender=Ingredient)
+def inventory_before(sender, **kwargs):
+    from .inventory import saved_state, saves_inventory
+    instance = kwargs.get('instance')
+    instance._inventory_before = None
+    if (instance.pk and not kwargs.get('raw') and
+            saves_inventory(kwargs.get('update_fields'))):
+        instance._inventory_before = saved_state(instance)
+
+
+@receiver(signals.post_save, sender=Ingredient)
+def inventory_after(sender, **kwargs):
+    from .inventory import InventoryChanges, remember, saves_inventory, state
+    instance = kwargs.get('instance')
+    if kwargs.get('raw') or not saves_inventory(kwargs.get('update_fields')):
+        return
+    changes, before = InventoryChanges(), instance._inventory_before
+    if before is not None:
+        changes.change(before[0], before[1], before=before[2:])
+    changes.change(instance.owner_id, instance.product_id,
+                   after=state(instance))
+    changes.apply()
+    remember(instance, kwargs.get('update_fields'), before)
+
+
+@receiver(signals.pre_delete, sender=Ingredient)
+def inventory_remove(sender, **kwargs):
+    # After clean_tickets, which may have changed the ingredient's usage
+    from .inventory import InventoryChanges, stored_state
+    before = stored_state(kwargs.get('instance').pk)
+    if before is not None:
+        changes = InventoryChanges()
+        changes.change(before[0], before[1], before=before[2:])
+        changes.apply()
+
+
+@receiver(signals.pre_save, sender=Meal)
+def rollup_before(sender, **kwargs):
+    from .rollups import stored_state
+    instance = kwargs.get('instance')
+    instance._rollup_before = None
+    if instance.pk and not kwargs.get('raw'):
+        instance._rollup_before = stored_state(instance.pk)
+
+
+@receiver(signals.post_save, sender=Meal)
+def rollup_after(sender, **kwargs):
+    from .rollups import SpendChanges, state
+    instance = kwargs.get('instance')
+    if kwargs.get('raw'):
+        return
+    changes = SpendChanges()
+    if instance._rollup_before is not None:
+        changes.change(*instance._rollup_before, sign=-1)
+    changes.change(*state(instance))
+    changes.apply()
+
+
+@receiver(signals.pre_delete, sender=Meal)
+def rollup_remove(sender, **kwargs):
+    from .rollups import SpendChanges, stored_state
+    before = stored_state(kwargs.get('instance').pk)
+    if before is not None:
+        changes = SpendChanges()
+        changes.change(*before, sign=-1)
+        changes.apply()
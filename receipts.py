@@ -0,0 +1,174 @@
+"""Bulk import of purchases from CSV receipts
+
+A receipt has a header row naming its columns: ``product``, ``price``,
+``amount``, ``best_before`` and ``purchase_date``, and optionally
+``currency``, ``expiry_type`` and ``partial``.  As in the form, the amount of
+a fixed product is its usual one; the purchase date defaults to today.
+Products are given by primary key, name or full description, and looked up
+in the cached catalogue rather than one query per row.  Rows are read one at
+a time, checked with the same rules as ``IngredientForm`` and inserted
+``CHUNK`` at a time; a bad row is reported with its line number and skipped,
+without stopping the import.  The whole import is one transaction, so a file
+that cannot be read to the end imports nothing.
+"""
+import csv
+import math
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.validators import DecimalValidator
+from django.db import transaction
+from django.utils.dateparse import parse_date
+from moneyed import CurrencyDoesNotExist, Money, get_currency
+
+from . import audit, caching
+from .forms import check_purchase
+from .inventory import InventoryChanges, state
+from .models import Ingredient
+
+REQUIRED = ('product', 'price', 'best_before')
+CHUNK = 500
+TRUE = ('1', 'y', 'yes', 'true')
+EXPIRY_TYPES = dict([(code, code) for code, _ in Ingredient.EXP_CHOICES] +
+                    [(name, code) for code, name in Ingredient.EXP_CHOICES])
+_AMBIGUOUS = object()
+_PRICE = Ingredient._meta.get_field('price')
+
+
+class RowError(ValueError):
+    pass
+
+
+def product_lookup(currency):
+    """Products priced in ``currency`` by pk, name and description"""
+    products = {}
+    for product in caching.product_catalogue(currency):
+        products[str(product.pk)] = product
+        for key in (product.name.lower(), str(product).lower()):
+            if products.get(key, product) is not product:
+                products[key] = _AMBIGUOUS
+            else:
+                products[key] = product
+    return products
+
+
+def _date(row, field, default=None):
+    value = (row.get(field) or "").strip()
+    if not value:
+        if default is None:
+            raise RowError("%s: This field is required." % field)
+        return default
+    try:
+        parsed = parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise RowError("%s: Enter a valid date." % field)
+    return parsed
+
+
+def _number(row, field, required=True, validator=None):
+    value = (row.get(field) or "").strip()
+    if not value:
+        if required:
+            raise RowError("%s: This field is required." % field)
+        return None
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        number = None
+    if number is None or not number.is_finite():
+        raise RowError("%s: Enter a number." % field)
+    if validator is not None:
+        try:
+            validator(number)
+        except ValidationError as e:
+            raise RowError("%s: %s" % (field, " ".join(e.messages)))
+    return number
+
+
+def parse_row(row, profile, products):
+    """An unsaved ``Ingredient`` for one CSV row, or raise ``RowError``"""
+    name = (row.get('product') or "").strip()
+    product = products.get(name.lower())
+    if product is None:
+        raise RowError("product: No product %r in %s" % (name,
+                                                         profile.currency))
+    if product is _AMBIGUOUS:
+        raise RowError("product: %r matches several products" % name)
+
+    code = (row.get('currency') or profile.currency).strip()
+    try:
+        currency = get_currency(code)
+    except CurrencyDoesNotExist:
+        raise RowError("currency: No currency %r" % code)
+    price = Money(_number(row, 'price', validator=DecimalValidator(
+                      _PRICE.max_digits, _PRICE.decimal_places)), currency)
+    amount = _number(row, 'amount', required=False)
+    if amount is not None:
+        # Finite as a Decimal, but possibly too large for a float
+        amount = float(amount)
+        if math.isinf(amount):
+            raise RowError("amount: Enter a number.")
+    partial = (row.get('partial') or "").strip().lower() in TRUE
+    amount, errors = check_purchase(product, price, amount, partial,
+                                    get_currency(profile.currency))
+    if errors:
+        raise RowError("; ".join("%s: %s" % error for error in errors))
+
+    expiry_type = (row.get('expiry_type') or Ingredient.BEST_BEFORE).strip()
+    if expiry_type not in EXPIRY_TYPES:
+        raise RowError("expiry_type: Select a valid choice.")
+    return Ingredient(owner=profile, product=product, price=price,
+                      amount=amount, expiry_type=EXPIRY_TYPES[expiry_type],
+                      best_before=_date(row, 'best_before'),
+                      purchase_date=_date(row, 'purchase_date',
+                                          date.today()))
+
+
+def _insert(ingredients):
+    Ingredient.objects.bulk_create(ingredients)
+    # No signals from bulk_create, so the audit log and inventory are
+    # updated here
+    audit.record_created(
+        Ingredient, ingredients,
+        Ingredient.objects.filter(owner=ingredients[0].owner_id))
+    changes = InventoryChanges()
+    for ingredient in ingredients:
+        changes.change(ingredient.owner_id, ingredient.product_id,
+                       after=state(ingredient))
+    changes.apply()
+    return len(ingredients)
+
+
+def import_receipt(profile, lines, chunk=CHUNK):
+    """Add the purchases in CSV ``lines`` to ``profile``'s inventory
+
+    ``lines`` is any iterable of text lines, such as an open file.  Returns
+    the number of ingredients created and a list of ``(line, message)`` for
+    the rows that were skipped.
+    """
+    reader = csv.DictReader(lines)
+    missing = [field for field in REQUIRED
+               if field not in (reader.fieldnames or ())]
+    if missing:
+        return 0, [(1, "Missing columns: %s" % ", ".join(missing))]
+
+    products = product_lookup(profile.currency)
+    created, errors, batch = 0, [], []
+    with transaction.atomic():
+        for row in reader:
+            try:
+                batch.append(parse_row(row, profile, products))
+            except RowError as e:
+                errors.append((reader.line_num, str(e)))
+            if len(batch) >= chunk:
+                created += _insert(batch)
+                batch = []
+        if batch:
+            created += _insert(batch)
+        if created:
+            caching.invalidate_inventory([profile.pk])
+            caching.invalidate_expiring([profile.pk])
+    return created, errors
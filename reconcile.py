@@ -0,0 +1,88 @@
+"""Checking and repairing denormalised costs
+
+Ticket costs follow from their ingredient (``used`` times the ingredient's
+cost per unit), and dish and meal totals from the tickets below them.
+``reconcile`` recomputes all three for one profile from one joined query
+over its tickets, summing the dish and meal totals from the expected ticket
+costs rather than the stored ones, and compares each with what is stored.
+With ``repair`` the drifted rows are rewritten in bulk and the profile's
+spend rollups are rebuilt.  The
+profile's tickets, dishes and meals are locked first, in the order that cost
+changes write them, so that none can change between the sums and the repair.
+"""
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from moneyed import Money
+
+from . import rollups
+from .caching import invalidate_meals
+from .costing import _bulk_set, cost_per_unit, quantize_cost
+from .models import Dish, Meal, Ticket
+
+SAMPLE = 10     # drifted rows reported per model
+
+
+def _compare(stored, expected, drift):
+    """Record rows of ``stored`` ((pk, open, closed)) that differ
+
+    ``expected`` holds the ``[open, closed]`` totals by pk.
+    """
+    for pk, cost_open, cost_closed in stored:
+        should = tuple(quantize_cost(total)
+                       for total in expected.get(pk, (0, 0)))
+        if (quantize_cost(cost_open), quantize_cost(cost_closed)) != should:
+            drift[pk] = {'cost_open': should[0], 'cost_closed': should[1]}
+
+
+def reconcile(profile_pk, repair=False):
+    """Check (and optionally repair) a profile's ticket, dish and meal costs
+
+    Returns ``{'tickets': n, 'dishes': n, 'meals': n}`` counts of drifted
+    rows, and ``'samples'`` of the first few: ``(model, pk, expected)``.
+    """
+    tickets = Ticket.objects.filter(dish__meal__owner=profile_pk)
+    drift = OrderedDict((name, {}) for name in ('tickets', 'dishes',
+                                                'meals'))
+    dishes = Dish.objects.filter(meal__owner=profile_pk)
+    meals = Meal.objects.filter(owner=profile_pk)
+    with transaction.atomic():
+        if repair:
+            for rows in (tickets, dishes, meals):
+                list(rows.select_for_update().values_list('pk', flat=True))
+        dish_totals = defaultdict(lambda: [Decimal(0), Decimal(0)])
+        meal_totals = defaultdict(lambda: [Decimal(0), Decimal(0)])
+        for pk, used, cost, final, dish_pk, meal_pk, currency, price, \
+                used_amount in tickets.values_list(
+                    'pk', 'used', 'cost', 'final', 'dish_id',
+                    'dish__meal_id', 'ingredient__price_currency',
+                    'ingredient__price',
+                    'ingredient__used_amount').iterator():
+            expected = quantize_cost((used * cost_per_unit(
+                Money(price, currency), used_amount)).amount)
+            if quantize_cost(cost) != expected:
+                drift['tickets'][pk] = {'cost': expected}
+            dish_totals[dish_pk][final] += expected
+            meal_totals[meal_pk][final] += expected
+
+        _compare(dishes.values_list(
+            'pk', 'cost_open', 'cost_closed').iterator(),
+            dish_totals, drift['dishes'])
+        _compare(meals.values_list(
+            'pk', 'cost_open', 'cost_closed').iterator(),
+            meal_totals, drift['meals'])
+
+        if repair:
+            _bulk_set(Ticket, drift['tickets'])
+            _bulk_set(Dish, drift['dishes'])
+            _bulk_set(Meal, drift['meals'])
+            if drift['meals']:
+                rollups.rebuild([profile_pk])
+                invalidate_meals(drift['meals'])
+
+    result = {name: len(rows) for name, rows in drift.items()}
+    result['samples'] = [(name, pk, expected)
+                         for name, rows in drift.items()
+                         for pk, expected in sorted(rows.items())[:SAMPLE]]
+    return result
@@ -0,0 +1,134 @@
+"""Spend rollups for grain
+
+``SpendRollup`` holds meal costs and counts per profile, consumer, meal type
+and week or month.  Whenever a meal's costs change, the same deltas are
+added to its two rollup rows, so reports over a year read a few dozen rows
+instead of every meal.  ``rebuild`` recomputes the rows from the meals.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Meal, SpendRollup
+
+FIELDS = ('cost_open', 'cost_closed', 'meals')
+BATCH = 500
+
+
+def meal_day(time):
+    if timezone.is_aware(time):
+        time = timezone.localtime(time)
+    return time.date()
+
+
+def periods(day):
+    """``(period, start)`` of the week and month containing ``day``"""
+    return ((SpendRollup.WEEK, day - timedelta(days=day.weekday())),
+            (SpendRollup.MONTH, day.replace(day=1)))
+
+
+def state(meal):
+    """The fields of a meal that count towards its rollups"""
+    return (meal.owner_id, meal.consumer_id, meal.meal_type,
+            meal_day(meal.time), meal.cost_open.amount,
+            meal.cost_closed.amount)
+
+
+def stored_state(pk):
+    """``state`` of a meal as saved, or None"""
+    row = Meal.objects.filter(pk=pk).values_list(
+        'owner_id', 'consumer_id', 'meal_type', 'time', 'cost_open',
+        'cost_closed').first()
+    if row is not None:
+        return row[:3] + (meal_day(row[3]),) + row[4:]
+
+
+class SpendChanges(object):
+    """Pending changes to spend rollup rows, written by ``apply``"""
+    def __init__(self):
+        self.rows = defaultdict(lambda: [Decimal(0), Decimal(0), 0])
+
+    def change(self, owner_pk, consumer_pk, meal_type, day, cost_open,
+               cost_closed, sign=1, meals=1):
+        for period, start in periods(day):
+            row = self.rows[owner_pk, consumer_pk, meal_type, period, start]
+            row[0] += sign * Decimal(cost_open)
+            row[1] += sign * Decimal(cost_closed)
+            row[2] += sign * meals
+
+    def meal_deltas(self, deltas):
+        """Add cost deltas given as {meal_pk: {field: delta}}"""
+        pks = list(deltas)
+        for i in range(0, len(pks), BATCH):
+            for pk, owner_pk, consumer_pk, meal_type, time in \
+                    Meal.objects.filter(pk__in=pks[i:i + BATCH]).values_list(
+                        'pk', 'owner_id', 'consumer_id', 'meal_type', 'time'):
+                self.change(owner_pk, consumer_pk, meal_type, meal_day(time),
+                            deltas[pk].get('cost_open', 0),
+                            deltas[pk].get('cost_closed', 0), meals=0)
+
+    def apply(self):
+        with transaction.atomic():
+            for key, deltas in self.rows.items():
+                if not any(deltas):
+                    continue
+                owner_pk, consumer_pk, meal_type, period, start = key
+                rollup = SpendRollup.objects.filter(
+                    owner_id=owner_pk, consumer_id=consumer_pk,
+                    meal_type=meal_type, period=period, start=start)
+                updates = {field: F(field) + delta
+                           for field, delta in zip(FIELDS, deltas)}
+                if not rollup.update(**updates):
+                    SpendRollup.objects.get_or_create(
+                        owner_id=owner_pk, consumer_id=consumer_pk,
+                        meal_type=meal_type, period=period, start=start)
+                    rollup.update(**updates)
+
+
+def rebuild(owner_pks=None):
+    """Recompute rollup rows from the meals, optionally for some profiles
+
+    Meals are summed per day in the database and folded into weeks and
+    months here.  Returns the number of rows written.
+    """
+    meals = Meal.objects.all()
+    rollups = SpendRollup.objects.all()
+    if owner_pks is not None:
+        meals = meals.filter(owner__in=owner_pks)
+        rollups = rollups.filter(owner__in=owner_pks)
+
+    changes = SpendChanges()
+    for row in meals.annotate(day=TruncDate('time')).values(
+            'owner_id', 'consumer_id', 'meal_type', 'day').annotate(
+            open=Sum('cost_open'), closed=Sum('cost_closed'),
+            count=Count('pk')).order_by():
+        changes.change(row['owner_id'], row['consumer_id'], row['meal_type'],
+                       row['day'], row['open'], row['closed'],
+                       meals=row['count'])
+
+    with transaction.atomic():
+        rollups.delete()
+        SpendRollup.objects.bulk_create(
+            SpendRollup(owner_id=key[0], consumer_id=key[1], meal_type=key[2],
+                        period=key[3], start=key[4], **dict(zip(FIELDS, row)))
+            for key, row in changes.rows.items())
+    return len(changes.rows)
+
+
+def spend(profile, period, start, end, by='consumer'):
+    """Spend of a profile per ``period`` starting in [start, end)
+
+    Grouped by ``consumer`` or ``meal_type``; rows are dicts with ``start``,
+    the group, ``open``, ``closed`` and ``count`` (of meals).
+    """
+    group = 'consumer__name' if by == 'consumer' else 'meal_type'
+    return SpendRollup.objects.filter(
+        owner=profile, period=period, start__gte=start, start__lt=end,
+        meals__gt=0).values('start', group).annotate(
+        open=Sum('cost_open'), closed=Sum('cost_closed'),
+        count=Sum('meals')).order_by('start', group)
@@ -0,0 +1,199 @@
+"""Synthetic datasets for grain
+
+``generate`` builds a realistic dataset from a seed: a shared product
+catalogue, and per profile some consumers, ingredients bought over two years
+and meals with dishes and tickets.  Most ingredients are used up within a
+few weeks of purchase, but a few staples stay open for the whole period and
+collect hundreds of tickets, which is what makes repricing expensive.
+
+Everything is inserted with ``bulk_create``, with every cost worked out
+beforehand as ``costing`` would have it, so the same seed and sizes always
+give the same data.
+"""
+import random
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from moneyed import Money
+
+from . import inventory, rollups
+from .costing import cost_per_unit, quantize_cost
+from .models import (Consumer, Dish, Ingredient, IngredientCategory, Meal,
+                     Product, Ticket, Unit, UserProfile, Vendor)
+
+# Sizes are per profile, except for the catalogue
+TIERS = OrderedDict([
+    ('small', {'profiles': 1, 'consumers': 2, 'products': 200,
+               'ingredients': 500, 'meals': 2000}),
+    ('medium', {'profiles': 2, 'consumers': 3, 'products': 1000,
+                'ingredients': 2000, 'meals': 8000}),
+    ('large', {'profiles': 4, 'consumers': 4, 'products': 3000,
+               'ingredients': 5000, 'meals': 20000}),
+])
+CURRENCIES = ('GBP', 'EUR', 'USD')
+DAYS = 730                  # history covered by the meals
+STAPLE_SHARE = 0.02         # of ingredients, kept open throughout
+STAPLE_TICKETS = 0.25       # of tickets, drawn on a staple
+SHELF_LIFE = 30             # days an ingredient is used after purchase
+BATCH = 500
+
+
+def generate(seed=0, end=None, **sizes):
+    """Create a dataset and return its user and profiles
+
+    ``sizes`` override those of the small tier; meals run up to ``end``,
+    today by default.
+    """
+    rng = random.Random(seed)
+    sizes = dict(TIERS['small'], **sizes)
+    end = end or date.today()
+
+    with transaction.atomic():
+        user, _ = User.objects.get_or_create(username="synthetic-%d" % seed)
+        products = _catalogue(rng, seed, sizes['products'])
+        profiles = [_profile(rng, seed, i, user, products, end, sizes)
+                    for i in range(sizes['profiles'])]
+        owner_pks = [profile.pk for profile in profiles]
+        inventory.rebuild(owner_pks)
+        rollups.rebuild(owner_pks)
+    return user, profiles
+
+
+def _catalogue(rng, seed, count):
+    units = [Unit.objects.get_or_create(short=short, defaults={
+        'verbose': verbose, 'plural': verbose + "s"})[0]
+        for short, verbose in (("g", "gram"), ("ml", "millilitre"),
+                               ("ea", "item"))]
+    root = IngredientCategory.objects.create(name="Synthetic %d" % seed)
+    categories = [root]
+    for i in range(12):
+        categories.append(IngredientCategory.objects.create(
+            name="Category %d" % i, parent=rng.choice(categories)))
+    vendors = [Vendor.objects.create(name="Vendor %d" % i) for i in range(5)]
+
+    Product.objects.bulk_create((
+        Product(name="Product %d" % i, category=rng.choice(categories),
+                vendor=rng.choice(vendors + [None]), units=rng.choice(units),
+                price=Money(rng.randint(20, 1500) / 100.0,
+                            rng.choice(CURRENCIES)),
+                amount=rng.choice((1, 6, 100, 250, 500, 1000)),
+                fixed=rng.random() < 0.8)
+        for i in range(count)), batch_size=BATCH)
+    return list(Product.objects.filter(category__in=categories).order_by('pk'))
+
+
+def _profile(rng, seed, index, user, products, end, sizes):
+    currency = CURRENCIES[index % len(CURRENCIES)]
+    profile = UserProfile.objects.create(
+        note="synthetic %d/%d" % (seed, index), currency=currency)
+    profile.user.add(user)
+    consumers = [Consumer.objects.create(
+        owner=profile, name="Consumer %d" % i,
+        actual_user=user if i == 0 else None)
+        for i in range(sizes['consumers'])]
+    start = end - timedelta(days=DAYS)
+
+    # Ingredients, in order of purchase; staples are bought before the start
+    ingredients = []
+    for i in range(sizes['ingredients']):
+        staple = i < max(1, int(sizes['ingredients'] * STAPLE_SHARE))
+        bought = start - timedelta(days=1) if staple else start + timedelta(
+            days=rng.randint(0, DAYS))
+        ingredients.append({
+            'product': rng.choice(products), 'staple': staple,
+            'purchase_date': bought,
+            'best_before': (end + timedelta(days=365) if staple else
+                            bought + timedelta(days=rng.randint(2, 60))),
+            'price': Money(rng.randint(20, 1500) / 100.0, currency),
+            'used_amount': 0.0})
+    staples = [item for item in ingredients if item['staple']]
+    fresh = sorted((item for item in ingredients if not item['staple']),
+                   key=lambda item: item['purchase_date'])
+    bought_days = [item['purchase_date'] for item in fresh]
+
+    # Meals with their dishes and tickets, planned before anything is saved
+    meals = []
+    for _ in range(sizes['meals']):
+        when = datetime.combine(
+            start + timedelta(days=rng.randint(0, DAYS)),
+            time(rng.randint(6, 22), rng.randint(0, 59)))
+        dishes = []
+        for _ in range(rng.randint(1, 2)):
+            lines = []
+            for _ in range(rng.randint(1, 3)):
+                low = bisect_left(bought_days, when.date() - timedelta(
+                    days=SHELF_LIFE))
+                high = bisect_right(bought_days, when.date())
+                if rng.random() < STAPLE_TICKETS or low == high:
+                    item = rng.choice(staples)
+                else:
+                    item = fresh[rng.randrange(low, high)]
+                used = round(rng.uniform(0.5, 200), 2)
+                item['used_amount'] += used
+                lines.append((item, used))
+            dishes.append((rng.choice(Dish.COOKING_STYLES)[0], lines))
+        meals.append((when, rng.choice(Meal.MEAL_CHOICES)[0],
+                      rng.choice(consumers), dishes))
+    meals.sort(key=lambda meal: meal[0])
+
+    for item in ingredients:
+        item['amount'] = max(item['used_amount'],
+                             float(item['product'].amount)) * 1.25
+        item['exhausted'] = (not item['staple'] and
+                             item['purchase_date'] < end - timedelta(
+                                 days=SHELF_LIFE) and rng.random() < 0.9)
+        item['cpu'] = cost_per_unit(item['price'], item['used_amount'])
+
+    Ingredient.objects.bulk_create((Ingredient(
+        owner=profile, product=item['product'], price=item['price'],
+        amount=item['amount'], used_amount=item['used_amount'],
+        expiry_type=Ingredient.BEST_BEFORE,
+        purchase_date=item['purchase_date'],
+        best_before=item['best_before'], exhausted=item['exhausted'])
+        for item in ingredients), batch_size=BATCH)
+    for item, pk in zip(ingredients, Ingredient.objects.filter(
+            owner=profile).order_by('pk').values_list('pk', flat=True)):
+        item['pk'] = pk
+
+    # Costs per ticket, summed into dishes and meals
+    for i, (when, meal_type, consumer, dishes) in enumerate(meals):
+        meal_costs = [0, 0]
+        for j, (method, lines) in enumerate(dishes):
+            tickets, dish_costs = [], [0, 0]
+            for item, used in lines:
+                cost = quantize_cost((used * item['cpu']).amount)
+                tickets.append((item, used, cost))
+                dish_costs[item['exhausted']] += cost
+            dishes[j] = (method, tickets, dish_costs)
+            meal_costs = [a + b for a, b in zip(meal_costs, dish_costs)]
+        meals[i] = (when, meal_type, consumer, dishes, meal_costs)
+
+    Meal.objects.bulk_create((Meal(
+        owner=profile, consumer=consumer, meal_type=meal_type,
+        time=timezone.make_aware(when) if settings.USE_TZ else when,
+        cost_open=Money(costs[0], currency),
+        cost_closed=Money(costs[1], currency))
+        for when, meal_type, consumer, _, costs in meals), batch_size=BATCH)
+    meal_pks = Meal.objects.filter(owner=profile).order_by('pk').values_list(
+        'pk', flat=True)
+
+    Dish.objects.bulk_create((Dish(
+        meal_id=meal_pk, method=method, cost_open=Money(costs[0], currency),
+        cost_closed=Money(costs[1], currency))
+        for meal, meal_pk in zip(meals, meal_pks)
+        for method, _, costs in meal[3]), batch_size=BATCH)
+    dish_pks = Dish.objects.filter(meal__owner=profile).order_by(
+        'pk').values_list('pk', flat=True)
+
+    dishes = (dish for meal in meals for dish in meal[3])
+    Ticket.objects.bulk_create((Ticket(
+        dish_id=dish_pk, ingredient_id=item['pk'], used=used,
+        cost=Money(cost, currency), final=item['exhausted'])
+        for (_, tickets, _), dish_pk in zip(dishes, dish_pks)
+        for item, used, cost in tickets), batch_size=BATCH)
+    return profile
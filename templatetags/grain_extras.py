@@ -1,26 +1,36 @@
 from datetime import date, timedelta
 
 from django import template
-from django.shortcuts import get_object_or_404
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from moneyed import Money
 
-from grain.models import UserProfile
+from grain.caching import calendar_grid
+from grain.forms import TicketPickerForm
+from grain.models import Meal
 
 register = template.Library()
 BASELINE_MAX = 4    # FIXME: magic: default max meal cost (progress bar)
+MEAL_DISPLAY = dict(Meal.MEAL_CHOICES)
 
 
 @register.inclusion_tag('grain/cal/calendar.html')
 def calendar(month, meals):
     weeks = []
-    # Get the first listed day
-    current_day = month - timedelta(days=month.weekday())
-    meals, meal_it, meal_count = meals.order_by('time'), 0, len(meals)
-    next_month = date(month.year if month.month < 12 else month.year + 1, month.month + 1 if month.month < 12 else 1, 1)
-
-    while meal_count > 0 and meals[meal_it].time.date() < current_day:
-        meal_it += 1
-
-    while current_day < next_month:
+    # Get the first listed day, and the Monday after the last
+    current_day, end_day = calendar_grid(month)
+
+    # One grouped query for the whole grid, rather than one row per meal
+    totals = {}
+    for row in meals.filter(time__gte=current_day, time__lt=end_day)\
+                    .annotate(day=TruncDate('time'))\
+                    .values('day', 'meal_type', 'cost_closed_currency')\
+                    .annotate(closed=Sum('cost_closed'),
+                              open=Sum('cost_open'))\
+                    .order_by('day', 'meal_type'):
+        totals.setdefault(row['day'], []).append(row)
+
+    while current_day < end_day:
         week = []
         for d in range(1, 8):
             day = {
@@ -31,25 +41,15 @@ def calendar(month, meals):
                 'meals': {},
             }
 
-            while (meal_it < meal_count and
-                   current_day == meals[meal_it].time.date()):
-                meal = meals[meal_it]
-                if meal.meal_type not in day['meals']:
-                    day['meals'][meal.meal_type] = {
-                        'display': meal.get_meal_type_display(),
-                        'close_pc': 0,
-                        'open_pc': 0,
-                        'total_price': 0,
-                        'meal_list': [],
-                    }
-                day['meals'][meal.meal_type]['total_price'] += meal.cost_closed\
-                                                             + meal.cost_open
-                day['meals'][meal.meal_type]['close_pc'] += 100 / BASELINE_MAX \
-                    * float(meal.cost_closed.amount)
-                day['meals'][meal.meal_type]['open_pc'] += 100 / BASELINE_MAX \
-                    * float(meal.cost_open.amount)
-                day['meals'][meal.meal_type]['meal_list'].append(meal)
-                meal_it += 1
+            for row in totals.get(current_day, []):
+                currency = row['cost_closed_currency']
+                day['meals'][row['meal_type']] = {
+                    'display': MEAL_DISPLAY[row['meal_type']],
+                    'close_pc': 100 / BASELINE_MAX * float(row['closed']),
+                    'open_pc': 100 / BASELINE_MAX * float(row['open']),
+                    'total_price': Money(row['closed'] + row['open'],
+                                         currency),
+                }
 
             current_day += timedelta(days=1)
             week.append(day)
@@ -64,8 +64,13 @@ def cal_cell(day):
 
 @register.inclusion_tag('grain/embeds/dish_list_embed.html')
 def dish_list(request, meal):
+    # Sorted in Python so that dishes prefetched by with_dishes are reused
+    dishes = sorted(meal.dish_set.all(), key=lambda d: (
+        -d.cost_closed.amount, -d.cost_open.amount, d.id))
     return {
-        'dishes': meal.dish_set.order_by('-cost_closed', '-cost_open', 'id'),
+        'dishes': dishes,
+        'ticket_form': TicketPickerForm(
+            request.session.get('grain_active_user_profile')),
         'request': request }
 
 
@@ -75,18 +80,12 @@ def cat_list(categories):
 
 
 @register.simple_tag
-def get_profile_name(pk):
-    if pk:
-        return get_object_or_404(UserProfile, pk=pk).note
+def get_profile_name(request):
+    if request.grain_profile is not None:
+        return request.grain_profile.note
     return "No profile selected"
 
 
 @register.inclusion_tag('grain/embeds/profile_list_nav.html')
-def get_profile_list(user):
-    return {'profiles': UserProfile.objects.filter(user=user).order_by('pk')}
-
-
-@register.inclusion_tag('grain/embeds/ingredient_form_embed.html')
-def ingredient_form_bootstrap(request, dish):
-    return {'form':
-        dish.get_ticket_form(request.session.get('grain_active_user_profile'))}
+def get_profile_list(request):
+    return {'profiles': request.grain_profiles}
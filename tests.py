@@ -1,3 +1,406 @@
-from django.test import TestCase
+import codecs
+from datetime import date, datetime
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from moneyed import Money
+
+from . import inventory
+from .costing import compact_ledger, recompute_from_ledger
+from .models import (Consumer, CostEntry, Dish, GrainEvent, Ingredient,
+                     IngredientCategory, Meal, Product, Ticket, Unit,
+                     UserProfile, Vendor)
+from .receipts import import_receipt
+from .reconcile import reconcile
+
+
+class MealQueryBudgetTest(TestCase):
+    """Meal pages must not issue queries per dish or per ticket"""
+    QUERY_BUDGET = 20
+
+    def setUp(self):
+        user = User.objects.create_user(username="cook", password="cook")
+        self.profile = UserProfile.objects.create(note="home")
+        self.profile.add_user(user)
+        self.consumer = Consumer.objects.create(owner=self.profile,
+                                                actual_user=user, name="cook")
+        self.unit = Unit.objects.create(short="g", verbose="gram",
+                                        plural="grams")
+        self.category = IngredientCategory.objects.create(name="Grains")
+        self.vendor = Vendor.objects.create(name="Market")
+
+        self.client.login(username="cook", password="cook")
+        session = self.client.session
+        session['grain_active_user_profile'] = self.profile.pk
+        session.save()
+
+    def make_meal(self, day, dishes, tickets_per_dish):
+        meal = Meal.objects.create(
+            owner=self.profile, time=datetime(2016, 10, day, 12),
+            meal_type=Meal.DINNER, consumer=self.consumer,
+            cost_open=Money(0, "GBP"), cost_closed=Money(0, "GBP"))
+        for d in range(dishes):
+            dish = Dish.objects.create(
+                method="boiling", meal=meal,
+                cost_open=Money(0, "GBP"), cost_closed=Money(0, "GBP"))
+            for t in range(tickets_per_dish):
+                product = Product.objects.create(
+                    name="rice %d.%d" % (d, t), vendor=self.vendor,
+                    category=self.category, price=Money(2, "GBP"),
+                    amount=500, units=self.unit)
+                ingredient = Ingredient.objects.create(
+                    owner=self.profile, product=product,
+                    price=Money(2, "GBP"), amount=500,
+                    best_before=date(2017, 1, 1),
+                    expiry_type=Ingredient.BEST_BEFORE)
+                Ticket.objects.create_ticket(ingredient, 50, dish, "GBP")
+        return meal
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_meal_detail(self):
+        small = self.make_meal(1, 1, 1)
+        large = self.make_meal(2, 6, 5)
+        small_count = self.count_queries(
+            reverse('grain:meal_detail', args=[small.pk]))
+        large_count = self.count_queries(
+            reverse('grain:meal_detail', args=[large.pk]))
+        self.assertEqual(small_count, large_count)
+        self.assertLessEqual(large_count, self.QUERY_BUDGET)
+
+    def test_meal_day(self):
+        self.make_meal(1, 1, 1)
+        self.make_meal(2, 3, 5)
+        self.make_meal(2, 3, 5)
+        small_count = self.count_queries(
+            reverse('grain:meal_day', args=[2016, 10, 1]))
+        large_count = self.count_queries(
+            reverse('grain:meal_day', args=[2016, 10, 2]))
+        self.assertEqual(small_count, large_count)
+        self.assertLessEqual(large_count, self.QUERY_BUDGET)
+
+
+class CostFixtures(object):
+    def setUp(self):
+        user = User.objects.create_user(username="cook", password="cook")
+        self.profile = UserProfile.objects.create(note="home")
+        self.consumer = Consumer.objects.create(owner=self.profile,
+                                                actual_user=user, name="cook")
+        self.product = Product.objects.create(
+            name="rice", vendor=Vendor.objects.create(name="Market"),
+            category=IngredientCategory.objects.create(name="Grains"),
+            price=Money(2, "GBP"), amount=500,
+            units=Unit.objects.create(short="g", verbose="gram",
+                                      plural="grams"))
+
+    def make_ingredient(self, price=2):
+        return Ingredient.objects.create(
+            owner=self.profile, product=self.product,
+            price=Money(price, "GBP"), amount=500,
+            best_before=date(2017, 1, 1), expiry_type=Ingredient.BEST_BEFORE)
+
+    def make_dish(self, meal=None):
+        if meal is None:
+            meal = Meal.objects.create(
+                owner=self.profile, time=datetime(2016, 10, 1, 12),
+                meal_type=Meal.DINNER, consumer=self.consumer,
+                cost_open=Money(0, "GBP"), cost_closed=Money(0, "GBP"))
+        return Dish.objects.create(method="boiling", meal=meal,
+                                   cost_open=Money(0, "GBP"),
+                                   cost_closed=Money(0, "GBP"))
+
+    def assertCosts(self, obj, cost_open, cost_closed):
+        obj = type(obj).objects.get(pk=obj.pk)
+        self.assertEqual((obj.cost_open, obj.cost_closed),
+                         (Money(cost_open, "GBP"), Money(cost_closed, "GBP")))
+
+    def assertTicket(self, ticket, cost, final=False):
+        ticket = Ticket.objects.get(pk=ticket.pk)
+        self.assertEqual((ticket.cost, ticket.final),
+                         (Money(cost, "GBP"), final))
+
+
+class CostPropagationTest(CostFixtures, TestCase):
+    """Ticket, dish and meal costs after repricing, closing and removal"""
+
+    def test_repricing(self):
+        rice, salt = self.make_ingredient(), self.make_ingredient(price=1)
+        first, second = self.make_dish(), self.make_dish()
+        other = self.make_dish(first.meal)
+        a = Ticket.objects.create_ticket(rice, 100, first, "GBP")
+        self.assertTicket(a, 2)
+        b = Ticket.objects.create_ticket(rice, 300, second, "GBP")
+        c = Ticket.objects.create_ticket(salt, 50, other, "GBP")
+
+        # 400g of rice used at £2: a and b share it 1:3
+        self.assertTicket(a, "0.5")
+        self.assertTicket(b, "1.5")
+        self.assertTicket(c, 1)
+        self.assertCosts(first, "0.5", 0)
+        self.assertCosts(other, 1, 0)
+        self.assertCosts(first.meal, "1.5", 0)
+        self.assertCosts(second.meal, "1.5", 0)
+
+        Ticket.objects.get(pk=a.pk).update_usage(100)
+        self.assertTicket(a, "0.8")
+        self.assertTicket(b, "1.2")
+        self.assertCosts(first.meal, "1.8", 0)
+        self.assertCosts(second, "1.2", 0)
+
+    def test_exhausting(self):
+        rice, salt = self.make_ingredient(), self.make_ingredient(price=1)
+        first, second = self.make_dish(), self.make_dish()
+        a = Ticket.objects.create_ticket(rice, 100, first, "GBP")
+        b = Ticket.objects.create_ticket(rice, 300, second, "GBP")
+        Ticket.objects.create_ticket(salt, 50, first, "GBP")
+
+        Ingredient.objects.get(pk=rice.pk).set_exhausted(True)
+        self.assertTicket(a, "0.5", final=True)
+        self.assertTicket(b, "1.5", final=True)
+        self.assertCosts(first, 1, "0.5")
+        self.assertCosts(first.meal, 1, "0.5")
+        self.assertCosts(second.meal, 0, "1.5")
+
+        Ingredient.objects.get(pk=rice.pk).set_exhausted(False)
+        self.assertTicket(a, "0.5")
+        self.assertCosts(first.meal, "1.5", 0)
+        self.assertCosts(second.meal, "1.5", 0)
+
+    def test_bulk_creation(self):
+        rice, salt = self.make_ingredient(), self.make_ingredient(price=1)
+        first, second = self.make_dish(), self.make_dish()
+        a = Ticket.objects.create_ticket(rice, 100, first, "GBP")
+        Ticket.objects.create_tickets(
+            second, [(rice, 100, False), (rice, 200, True),
+                     (salt, 50, False)], "GBP")
+
+        self.assertTicket(a, "0.5", final=True)
+        self.assertCosts(first.meal, 0, "0.5")
+        self.assertCosts(second, 1, "1.5")
+        self.assertTrue(Ingredient.objects.get(pk=rice.pk).exhausted)
+
+    def test_removal(self):
+        rice = self.make_ingredient()
+        first, second = self.make_dish(), self.make_dish()
+        a = Ticket.objects.create_ticket(rice, 100, first, "GBP")
+        Ticket.objects.create_ticket(rice, 300, second, "GBP")
+
+        second.delete()
+        self.assertTicket(a, 2)
+        self.assertCosts(first.meal, 2, 0)
+        self.assertCosts(second.meal, 0, 0)
+        self.assertEqual(Ingredient.objects.get(pk=rice.pk).used_amount, 100)
+
+
+class ReconcileTest(CostFixtures, TestCase):
+    """Drifted ticket, dish and meal costs are found and repaired"""
+
+    def test_repair(self):
+        dish = self.make_dish()
+        ticket = Ticket.objects.create_ticket(self.make_ingredient(), 100,
+                                              dish, "GBP")
+        self.assertCosts(dish.meal, 2, 0)
+        Ticket.objects.filter(pk=ticket.pk).update(cost=Decimal(1))
+        Dish.objects.filter(pk=dish.pk).update(cost_open=Decimal(5))
+        Meal.objects.filter(pk=dish.meal_id).update(cost_closed=Decimal(3))
+
+        report = reconcile(self.profile.pk)
+        self.assertEqual([report[name] for name in
+                          ('tickets', 'dishes', 'meals')], [1, 1, 1])
+        self.assertCosts(dish, 5, 0)
+
+        reconcile(self.profile.pk, repair=True)
+        self.assertTicket(ticket, 2)
+        self.assertCosts(dish, 2, 0)
+        self.assertCosts(dish.meal, 2, 0)
+        report = reconcile(self.profile.pk)
+        self.assertEqual([report[name] for name in
+                          ('tickets', 'dishes', 'meals')], [0, 0, 0])
+
+    def test_ticket_drift(self):
+        dish = self.make_dish()
+        ticket = Ticket.objects.create_ticket(self.make_ingredient(), 100,
+                                              dish, "GBP")
+        Ticket.objects.filter(pk=ticket.pk).update(cost=Decimal(1))
+        report = reconcile(self.profile.pk)
+        self.assertEqual([report[name] for name in
+                          ('tickets', 'dishes', 'meals')], [1, 0, 0])
+        self.assertEqual(report['samples'],
+                         [('tickets', ticket.pk, {'cost': 2})])
+
+
+@override_settings(GRAIN_COST_LEDGER=True)
+class LedgerCompactionTest(CostFixtures, TestCase):
+    """Compacting the ledger must agree with recomputing from all of it"""
+
+    def totals(self):
+        return (list(Dish.objects.order_by('pk').values_list(
+                    'pk', 'cost_open', 'cost_closed')),
+                list(Meal.objects.order_by('pk').values_list(
+                    'pk', 'cost_open', 'cost_closed')))
+
+    def test_compaction(self):
+        rice, salt = self.make_ingredient(), self.make_ingredient(price=1)
+        first, second = self.make_dish(), self.make_dish()
+        a = Ticket.objects.create_ticket(rice, 100, first, "GBP")
+        Ticket.objects.create_ticket(salt, 50, first, "GBP")
+        compact_ledger()
+        self.assertCosts(first, 3, 0)
+
+        # A pk allocated now, but only committed after a later compaction
+        late = CostEntry.objects.create(dish=first, meal=first.meal,
+                                        final=False, amount=0)
+        late.delete()
+        Ticket.objects.create_ticket(rice, 300, second, "GBP")
+        Ingredient.objects.get(pk=salt.pk).set_exhausted(True)
+        compact_ledger()
+        CostEntry.objects.create(pk=late.pk, dish=first, meal=first.meal,
+                                 final=False, amount=Decimal("0.25"))
+        Ticket.objects.get(pk=a.pk).update_usage(100)
+        compact_ledger()
+
+        self.assertCosts(first, "1.05", 1)
+        self.assertFalse(CostEntry.objects.filter(compacted=False).exists())
+        compacted = self.totals()
+        recompute_from_ledger()
+        self.assertEqual(self.totals(), compacted)
+
+
+class AuditTest(CostFixtures, TransactionTestCase):
+    """Every change is logged once, including those made in bulk"""
+
+    def events(self, model, action):
+        return sorted(GrainEvent.objects.filter(
+            model=model.__name__, action=action).values_list('object_pk',
+                                                             flat=True))
+
+    def test_cascade(self):
+        rice, salt = self.make_ingredient(), self.make_ingredient(price=1)
+        dish = self.make_dish()
+        a = Ticket.objects.create_ticket(rice, 100, dish, "GBP")
+        b = Ticket.objects.create_ticket(salt, 50, dish, "GBP")
+
+        dish_pk = dish.pk
+        dish.delete()
+        self.assertEqual(self.events(Ticket, GrainEvent.DELETE),
+                         [a.pk, b.pk])
+        self.assertEqual(self.events(Dish, GrainEvent.DELETE), [dish_pk])
+        self.assertCosts(dish.meal, 0, 0)
+
+        c = Ticket.objects.create_ticket(rice, 100, self.make_dish(), "GBP")
+        Ingredient.objects.get(pk=rice.pk).delete()
+        self.assertEqual(self.events(Ticket, GrainEvent.DELETE),
+                         [a.pk, b.pk, c.pk])
+
+    def test_bulk(self):
+        rice, salt = self.make_ingredient(), self.make_ingredient(price=1)
+        dish = self.make_dish()
+        GrainEvent.objects.all().delete()
+        Ticket.objects.create_tickets(
+            dish, [(rice, 100, False), (salt, 50, True)], "GBP")
+        tickets = sorted(dish.ticket_set.values_list('pk', flat=True))
+        self.assertEqual(self.events(Ticket, GrainEvent.CREATE), tickets)
+        self.assertEqual(self.events(Ingredient, GrainEvent.EDIT),
+                         [rice.pk, salt.pk])
+        # Repriced tickets and their totals are derived, so not logged
+        self.assertEqual(self.events(Meal, GrainEvent.EDIT), [])
+
+        GrainEvent.objects.all().delete()
+        Ingredient.objects.get(pk=rice.pk).set_exhausted(True)
+        self.assertEqual(self.events(Ingredient, GrainEvent.EDIT), [rice.pk])
+        self.assertEqual(self.events(Ticket, GrainEvent.EDIT), [])
+
+    def test_repricing(self):
+        rice = self.make_ingredient()
+        counts = []
+        for tickets in (1, 20):
+            for _ in range(tickets):
+                Ticket.objects.create_ticket(rice, 10, self.make_dish(),
+                                             "GBP")
+            GrainEvent.objects.all().delete()
+            Ticket.objects.create_ticket(rice, 10, self.make_dish(), "GBP")
+            counts.append(GrainEvent.objects.count())
+        self.assertEqual(counts[0], counts[1])
+
+
+class ReceiptImportTest(CostFixtures, TransactionTestCase):
+    """Receipts import their good rows, and nothing from unreadable files"""
+
+    HEADER = "product,price,amount,best_before,purchase_date,currency\n"
+
+    def receipt(self, *rows):
+        return (self.HEADER + "".join(row + "\n" for row in rows)).encode()
+
+    def test_rows(self):
+        created, errors = import_receipt(self.profile, codecs.iterdecode(
+            self.receipt(
+                "rice,2.10,,2017-01-01,2016-10-01",
+                "Rice,1,250,2017-01-01,",
+                "bread,1,,2017-01-01,",
+                "rice,NaN,,2017-01-01,",
+                "rice,Infinity,,2017-01-01,",
+                "rice,1.005,,2017-01-01,",
+                "rice,123456789,,2017-01-01,",
+                "rice,1,-Infinity,2017-01-01,",
+                "rice,1,,someday,",
+                "rice,1,1e400,2017-01-01,",
+                "rice,1,,2017-01-01,,QQQ").splitlines(True), 'utf-8'))
+        self.assertEqual(created, 2)
+        self.assertEqual([line for line, _ in errors],
+                         [4, 5, 6, 7, 8, 9, 10, 11, 12])
+        self.assertEqual(errors[-1], (12, "currency: No currency 'QQQ'"))
+        self.assertEqual(sorted(Ingredient.objects.values_list(
+            'price', 'amount', 'purchase_date')), [
+            (Decimal('1.00'), 500, date.today()),
+            (Decimal('2.10'), 500, date(2016, 10, 1))])
+        self.assertEqual(inventory.rebuild(commit=False), [])
+
+    def test_encoding(self):
+        lines = self.receipt("rice,1,,2017-01-01,",
+                             "rice,2,,2017-01-01,").splitlines(True)
+        with self.assertRaises(UnicodeDecodeError):
+            import_receipt(self.profile, codecs.iterdecode(
+                lines + [b"\xff\xfe,1,,2017-01-01,\n"], 'utf-8'), chunk=1)
+        self.assertFalse(Ingredient.objects.exists())
+
+        user = User.objects.get(username="cook")
+        self.profile.user.add(user)
+        self.client.login(username="cook", password="cook")
+        self.client.get(reverse('grain:profile_select',
+                                args=[self.profile.pk]))
+        response = self.client.post(reverse('grain:receipt_import'), {
+            'receipt': SimpleUploadedFile("receipt.csv", b"\xff\xfe\x00")})
+        self.assertFormError(response, 'form', 'receipt',
+                             "Not a UTF-8 text file")
+        self.assertFalse(Ingredient.objects.exists())
+
+
+class CalendarEventsTest(CostFixtures, TransactionTestCase):
+    """The calendar feed's ETag follows its meals and their consumers"""
+
+    def test_rename(self):
+        self.make_dish()
+        self.profile.user.add(User.objects.get(username="cook"))
+        self.client.login(username="cook", password="cook")
+        self.client.get(reverse('grain:profile_select',
+                                args=[self.profile.pk]))
+        url = "%s?from=%d&to=%d" % (reverse('grain:calendar_events'),
+                                    1475280000000, 1477958400000)
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(
+            url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.consumer.name = "chef"
+        self.consumer.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("chef", response.content.decode())
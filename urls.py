@@ -56,6 +56,10 @@ urlpatterns = [
         views.MealMonthArchiveFull.as_view(month_format='%m'),
         name="calendar_all"),
 
+    url(r'^calendar/events\.json$',
+        views.calendar_events,
+        name="calendar_events"),
+
     url(r'^meals/date/(?P<year>[0-9]{4})/(?P<month>[0-9]+)/(?P<day>[0-9]+)/$',
         views.MealDayArchive.as_view(month_format='%m'),
         name="meal_day"),
@@ -92,10 +96,38 @@ urlpatterns = [
         views.IngredientListFull.as_view(),
         name="inventory_all"),
 
+    url(r'^inventory/import/$',
+        views.ReceiptImport.as_view(),
+        name="receipt_import"),
+
+    url(r'^reports/spend/$',
+        views.SpendReport.as_view(),
+        name="spend_report"),
+
+    url(r'^reports/spend\.json$',
+        views.spend_json,
+        name="spend_json"),
+
+    url(r'^export/meals\.(?P<format>csv|ndjson)$',
+        views.meal_export,
+        name="meal_export"),
+
+    url(r'^inventory/expiring\.json$',
+        views.expiring_json,
+        name="inventory_expiring"),
+
+    url(r'^inventory/report/$',
+        views.InventoryReport.as_view(),
+        name="inventory_report"),
+
     url(r'^ingredients/(?P<pk>\d+)/$',
         views.IngredientDetail.as_view(),
         name="ingredient_detail"),
 
+    url(r'^ingredients/picker/$',
+        views.ingredient_picker,
+        name="ingredient_picker"),
+
     url(r'^ingredient/create/$',
         views.IngredientCreate.as_view(),
         name="ingredient_create"),
@@ -132,6 +164,10 @@ urlpatterns = [
         views.product_raw,
         name="product_raw"),
 
+    url(r'^products/raw/batch/$',
+        views.product_raw_batch,
+        name="product_raw_batch"),
+
     url(r'^products/raw/$',
         page_not_found,     # FIXME
         name="product_raw_noid"),
@@ -144,7 +180,18 @@ urlpatterns = [
         views.ticket_create,
         name="ticket_create"),
 
+    url(r'^ticket/create/dish/(?P<pk>\d+)/$',
+        views.ticket_create_bulk,
+        name="ticket_create_bulk"),
+
     url(r'^ticket/delete/(?P<pk>\d+)/$',
         views.TicketDelete.as_view(),
         name="ticket_delete"),
+
+    url(r'^stats/cache/$',
+        views.cache_stats,
+        name="cache_stats"),
+    url(r'^stats/queries/$',
+        views.query_stats,
+        name="query_stats"),
 ]
@@ -1,30 +1,44 @@
+import codecs
+import hashlib
 import json
-from datetime import date, timedelta
+from calendar import timegm
+from datetime import date, datetime, timedelta
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import (PermissionRequiredMixin,
                                         UserPassesTestMixin)
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import get_object_or_404
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseRedirect, StreamingHttpResponse)
+from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
 from django.views import generic
+from django.views.decorators.http import condition
 from moneyed import Money
 
+from . import (caching, exports, instrumentation, inventory, receipts,
+               rollups)
 from .forms import (ConsumerForm, DishForm, IngredientForm, MealForm,
-                    ProductForm, TicketForm, UsernameForm)
-from .models import (Consumer, Dish, GrainEvent, Ingredient,
-                     IngredientCategory, Meal, Product, Ticket, Unit,
-                     UserProfile, Vendor)
+                    ProductForm, ReceiptForm, TicketForm, TicketLineFormSet,
+                    UsernameForm, open_ingredients)
+from .models import (Consumer, Dish, Ingredient, IngredientCategory, Meal,
+                     Product, SpendRollup, Ticket, Unit, UserProfile, Vendor)
 
 
-def get_profile(session):
-    if not session.get('grain_active_user_profile'):
+PICKER_PAGE_SIZE = 30
+
+
+def get_profile(request):
+    if request.grain_profile is None:
         # FIXME: ValidationError not quite appropriate
         raise PermissionDenied("No profile selected")
-    return get_object_or_404(UserProfile,
-                             pk=session['grain_active_user_profile'])
+    return request.grain_profile
 
 
 def cal_redirect(request):
@@ -36,12 +50,14 @@ def cal_redirect(request):
 
 
 class ProfileList(generic.ListView):
+    template_name = "grain/userprofile_list.html"
+
     def get_queryset(self):
-        return self.request.user.userprofile_set.all()
+        return self.request.grain_profiles
 
 
 def profile_remove_user(request, user_id):
-    profile = get_profile(request.session)
+    profile = get_profile(request)
     user_id = int(user_id)
 
     if user_id == request.user.id:
@@ -67,11 +83,11 @@ class ProfileUpdate(UserPassesTestMixin, generic.edit.FormView):
 
     def get_context_data(self, **kwargs):
         context = super(ProfileUpdate, self).get_context_data(**kwargs)
-        context['object'] = get_profile(self.request.session)
+        context['object'] = get_profile(self.request)
         return context
 
     def form_valid(self, form):
-        profile = get_profile(self.request.session)
+        profile = get_profile(self.request)
         if profile.user.filter(pk=form.cleaned_data['user'].pk).exists():
             messages.error(self.request, "User already a member")
         else:
@@ -87,9 +103,9 @@ class ProfileCreate(generic.edit.CreateView):
     success_url = reverse_lazy('grain:profile_list')
 
     def form_valid(self, form):
-        form.instance.save()
-        form.instance.user.add(self.request.user)
-        return super(ProfileCreate, self).form_valid(form)
+        response = super(ProfileCreate, self).form_valid(form)
+        self.object.user.add(self.request.user)
+        return response
 
 
 def profile_select(request, pk):
@@ -132,7 +148,7 @@ class ConsumerCreate(UserPassesTestMixin, generic.edit.CreateView):
 
     def get_form_kwargs(self):
         kwargs = super(ConsumerCreate, self).get_form_kwargs()
-        kwargs['profile'] = get_profile(self.request.session)
+        kwargs['profile'] = get_profile(self.request)
         return kwargs
 
 
@@ -144,7 +160,7 @@ class ConsumerDelete(UserPassesTestMixin, generic.edit.DeleteView):
 
     def test_func(self):
         return 'grain_active_user_profile' in self.request.session and \
-               get_profile(self.request.session) == self.get_object().owner
+               get_profile(self.request) == self.get_object().owner
 
     def get_context_data(self, **kwargs):
         context = super(ConsumerDelete, self).get_context_data(**kwargs)
@@ -155,7 +171,7 @@ class ConsumerDelete(UserPassesTestMixin, generic.edit.DeleteView):
         return context
 
     def post(self, request, *args, **kwargs):
-        profile = get_profile(request.session)
+        profile = get_profile(request)
         consumer = self.get_object()
 
         if profile.user.filter(pk=consumer.actual_user.pk).exists:
@@ -173,32 +189,30 @@ class MealMonthArchiveFull(UserPassesTestMixin, generic.dates.MonthArchiveView):
         return 'grain_active_user_profile' in self.request.session
 
     def get_queryset(self):
-        month = date(int(self.kwargs['year']), int(self.kwargs['month']), 1)
         return Meal.objects.filter(
-            owner__pk=self.request.session['grain_active_user_profile'],
-            time__gt=(month - timedelta(days=7)),
-            time__lt=(month + timedelta(days=38)))
+            owner__pk=self.request.session['grain_active_user_profile'])
 
     def get_context_data(self, **kwargs):
         context = super(MealMonthArchiveFull, self).get_context_data(**kwargs)
         month = date(int(self.kwargs['year']), int(self.kwargs['month']), 1)
 
-        context['object_list'] = self.get_queryset()
         context['meal_form'] = MealForm(
             profile_id=self.request.session['grain_active_user_profile'])
         context['full'] = True
         context['link'] = "grain:calendar_all"
-        context['profile'] = get_profile(self.request.session)
+        context['profile'] = get_profile(self.request)
+        context['calendar'] = self.get_calendar(month, context['profile'])
         return context
 
+    def get_calendar(self, month, profile):
+        # Unevaluated: the calendar tag aggregates over its own date grid
+        return caching.calendar(month, self.get_queryset(), profile)
+
+
 class MealMonthArchive(MealMonthArchiveFull):
     def get_queryset(self):
-        month = date(int(self.kwargs['year']), int(self.kwargs['month']), 1)
-
         return Meal.objects.filter(consumer__actual_user=self.request.user,
-            cost_open__gte=Money(0, get_profile(self.request.session).currency),
-            time__gt=(month - timedelta(days=7)),
-            time__lt=(month + timedelta(days=38)))
+            cost_open__gte=Money(0, get_profile(self.request).currency))
 
     def get_context_data(self, **kwargs):
         context = super(MealMonthArchive, self).get_context_data(**kwargs)
@@ -206,6 +220,109 @@ class MealMonthArchive(MealMonthArchiveFull):
         context['link'] = "grain:calendar"
         return context
 
+    def get_calendar(self, month, profile):
+        return caching.calendar(month, self.get_queryset(), profile,
+                                self.request.user)
+
+
+MAX_EVENT_DAYS = 400
+
+
+def from_timestamp(ms):
+    when = datetime.fromtimestamp(ms / 1000.0, timezone.utc)
+    return when if settings.USE_TZ else timezone.make_naive(when)
+
+
+def to_timestamp(when):
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return timegm(when.utctimetuple()) * 1000
+
+
+def local_date(when):
+    return (timezone.localtime(when) if timezone.is_aware(when) else
+            when).date()
+
+
+def event_range(request):
+    """``from`` and ``to`` of a calendar events request, in milliseconds"""
+    try:
+        start, end = [from_timestamp(int(request.GET[key]))
+                      for key in ('from', 'to')]
+    except (KeyError, ValueError):
+        raise ValueError("from and to must be timestamps in milliseconds")
+    if not start < end <= start + timedelta(days=MAX_EVENT_DAYS):
+        raise ValueError("Bad range")
+    return start, end
+
+
+def calendar_events_etag(request):
+    try:
+        start, end = event_range(request)
+    except ValueError:
+        return None
+    profile = get_profile(request)
+    return hashlib.md5(("%s:%s:%s:%s:%s" % (
+        profile.pk, request.GET['from'], request.GET['to'],
+        request.GET.get('group'),
+        caching.calendar_versions(profile.pk, local_date(start),
+                                  local_date(end)))).encode()).hexdigest()
+
+
+@condition(etag_func=calendar_events_etag)
+def calendar_events(request):
+    """Meals between ``from`` and ``to`` as bootstrap-calendar events
+
+    One event per meal, or per day and meal type with ``group=day``.  An
+    ETag changes only when a meal in the range does.
+    """
+    profile = get_profile(request)
+    try:
+        start, end = event_range(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    meals = Meal.objects.filter(owner=profile, time__gte=start, time__lt=end)
+    meal_types = dict(Meal.MEAL_CHOICES)
+
+    def event(pk, title, url, when, length, cost_open, cost_closed, **extra):
+        begin = to_timestamp(when)
+        return dict(extra, id=pk, title=title, url=url, start=begin,
+                    end=begin + int(length.total_seconds() * 1000),
+                    cost_open=str(cost_open), cost_closed=str(cost_closed),
+                    currency=profile.currency,
+                    **{'class': "event-warning" if cost_open else
+                       "event-success"})
+
+    if request.GET.get('group') == 'day':
+        result = [event(
+            "%s-%s" % (row['day'].isoformat(), row['meal_type']),
+            "%s x%d (%s)" % (meal_types[row['meal_type']], row['count'],
+                             Money(row['open'] + row['closed'],
+                                   profile.currency)),
+            reverse('grain:meal_day_spec', args=[
+                row['day'].year, row['day'].month, row['day'].day,
+                row['meal_type']]),
+            datetime.combine(row['day'], datetime.min.time()),
+            timedelta(days=1), row['open'], row['closed'],
+            meal_type=row['meal_type'], meals=row['count'])
+            for row in meals.annotate(day=TruncDate('time')).values(
+                'day', 'meal_type').annotate(
+                count=Count('pk'), open=Sum('cost_open'),
+                closed=Sum('cost_closed')).order_by('day', 'meal_type')]
+    else:
+        result = [event(
+            pk, "%s: %s (%s)" % (meal_types[meal_type], consumer,
+                                 Money(cost_open + cost_closed,
+                                       profile.currency)),
+            reverse('grain:meal_detail', args=[pk]), when,
+            timedelta(hours=1), cost_open, cost_closed, meal_type=meal_type)
+            for pk, when, meal_type, consumer, cost_open, cost_closed
+            in meals.order_by('time', 'pk').values_list(
+                'pk', 'time', 'meal_type', 'consumer__name', 'cost_open',
+                'cost_closed')]
+    return HttpResponse(json.dumps({'success': 1, 'result': result}),
+                        content_type="application/json")
+
 
 class MealDayArchive(UserPassesTestMixin, generic.dates.DayArchiveView):
     date_field = "time"
@@ -217,7 +334,8 @@ class MealDayArchive(UserPassesTestMixin, generic.dates.DayArchiveView):
 
     def get_queryset(self):
         return Meal.objects.filter(
-            owner__pk=self.request.session['grain_active_user_profile'])
+            owner__pk=self.request.session['grain_active_user_profile'])\
+            .with_dishes()
 
 
 class MealDayArchiveSpecific(MealDayArchive):
@@ -239,7 +357,8 @@ class MealDetail(UserPassesTestMixin, generic.DetailView):
 
     def get_queryset(self):
         return Meal.objects.filter(
-            owner__pk=self.request.session['grain_active_user_profile'])
+            owner__pk=self.request.session['grain_active_user_profile'])\
+            .with_dishes()
 
     def get_context_data(self, **kwargs):
         context = super(MealDetail, self).get_context_data(**kwargs)
@@ -263,7 +382,7 @@ class MealCreate(UserPassesTestMixin, generic.edit.CreateView):
         return kwargs
 
     def form_valid(self, form):
-        profile = get_profile(self.request.session)
+        profile = get_profile(self.request)
 
         form.instance.owner = profile
         form.instance.cost_closed = Money(0, profile.currency)
@@ -299,7 +418,7 @@ class DishCreate(UserPassesTestMixin, generic.edit.CreateView):
         return 'grain_active_user_profile' in self.request.session
 
     def form_valid(self, form):
-        profile = get_profile(self.request.session)
+        profile = get_profile(self.request)
 
         if form.instance.meal.owner != profile:
             raise ValidationError("Wrong profile", code='invalid')
@@ -339,14 +458,14 @@ class IngredientListFull(UserPassesTestMixin, generic.ListView):
 
     def get_queryset(self):
         return Ingredient.objects.filter(
-            owner=get_profile(self.request.session)).order_by('purchase_date',
-                                                              'best_before')
+            owner=get_profile(self.request)).order_by('purchase_date',
+                                                      'best_before')
 
     def get_context_data(self, **kwargs):
         context = super(IngredientListFull, self).get_context_data(**kwargs)
         context['full'] = self.__class__ == IngredientListFull
         context['ingredient_form'] = \
-            IngredientForm(currency=get_profile(self.request.session).currency)
+            IngredientForm(currency=get_profile(self.request).currency)
         return context
 
 
@@ -358,9 +477,132 @@ class IngredientList(IngredientListFull):
     def get_context_data(self, **kwargs):
         context = super(IngredientList, self).get_context_data(**kwargs)
         context['full'] = False
+        context['expiring'] = caching.expiring_soon(
+            get_profile(self.request).pk)
+        return context
+
+
+def expiring_json(request):
+    return HttpResponse(json.dumps([
+        dict(item, best_before=item['best_before'].isoformat())
+        for item in caching.expiring_soon(get_profile(request).pk)
+    ]), content_type="application/json")
+
+
+class InventoryReport(UserPassesTestMixin, generic.TemplateView):
+    login_url = reverse_lazy("grain:profile_list")
+    template_name = 'grain/inventory_report.html'
+
+    def test_func(self):
+        return 'grain_active_user_profile' in self.request.session
+
+    def get_context_data(self, **kwargs):
+        context = super(InventoryReport, self).get_context_data(**kwargs)
+        context.update(inventory.report(get_profile(self.request)))
+        return context
+
+
+def spend_query(request):
+    """Period and date range of a spend report, from the query string
+
+    Defaults to the twelve months up to the end of this month.
+    """
+    period = request.GET.get('period', SpendRollup.MONTH)
+    if period not in dict(SpendRollup.PERIODS):
+        raise ValueError("Unknown period")
+    end = caching.next_month(date.today().replace(day=1))
+    if request.GET.get('to'):
+        end = datetime.strptime(request.GET['to'], "%Y-%m-%d").date()
+    start = end.replace(year=end.year - 1, day=1)
+    if request.GET.get('from'):
+        start = datetime.strptime(request.GET['from'], "%Y-%m-%d").date()
+    return period, start, end
+
+
+class SpendReport(UserPassesTestMixin, generic.TemplateView):
+    login_url = reverse_lazy("grain:profile_list")
+    template_name = 'grain/spend_report.html'
+
+    def test_func(self):
+        return 'grain_active_user_profile' in self.request.session
+
+    def get_context_data(self, **kwargs):
+        context = super(SpendReport, self).get_context_data(**kwargs)
+        profile = get_profile(self.request)
+        try:
+            period, start, end = spend_query(self.request)
+        except ValueError:
+            raise Http404("Bad report range")
+
+        meal_types = dict(Meal.MEAL_CHOICES)
+        by_consumer = list(rollups.spend(profile, period, start, end))
+        by_type = list(rollups.spend(profile, period, start, end,
+                                     by='meal_type'))
+        for row in by_consumer + by_type:
+            row['total'] = Money(row['open'] + row['closed'],
+                                 profile.currency)
+        for row in by_type:
+            row['meal_type'] = meal_types[row['meal_type']]
+        context.update({
+            'period': period,
+            'start': start,
+            'end': end,
+            'by_consumer': by_consumer,
+            'by_meal_type': by_type,
+        })
         return context
 
 
+def spend_json(request):
+    profile = get_profile(request)
+    by = request.GET.get('by', 'consumer')
+    try:
+        period, start, end = spend_query(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if by not in ('consumer', 'meal_type'):
+        return HttpResponseBadRequest("Unknown grouping")
+
+    group = 'consumer__name' if by == 'consumer' else 'meal_type'
+    return HttpResponse(json.dumps({
+        'currency': profile.currency,
+        'period': period,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'rows': [{
+            'start': row['start'].isoformat(),
+            by: row[group],
+            'open': str(row['open']),
+            'closed': str(row['closed']),
+            'meals': row['count'],
+        } for row in rollups.spend(profile, period, start, end, by=by)],
+    }), content_type="application/json")
+
+
+EXPORT_TYPES = {'csv': "text/csv", 'ndjson': "application/x-ndjson"}
+
+
+def meal_export(request, format):
+    """Meals with dishes and tickets, streamed as CSV or NDJSON
+
+    Limited to ``from`` and ``to`` (both inclusive) if given.
+    """
+    profile = get_profile(request)
+    try:
+        start, end = [
+            datetime.strptime(request.GET[key], "%Y-%m-%d").date()
+            if request.GET.get(key) else None for key in ('from', 'to')]
+    except ValueError:
+        return HttpResponseBadRequest("Bad date range")
+    lines = (exports.csv_lines if format == 'csv' else
+             exports.ndjson_lines)(profile, start, end)
+    response = StreamingHttpResponse(lines,
+                                     content_type=EXPORT_TYPES[format])
+    response['Content-Disposition'] = \
+        'attachment; filename="grain-meals.%s"' % format
+    return response
+
+
 class IngredientDetail(UserPassesTestMixin, generic.DetailView):
     login_url = reverse_lazy("grain:profile_list")
 
@@ -372,7 +614,7 @@ class IngredientDetail(UserPassesTestMixin, generic.DetailView):
             owner__pk=self.request.session['grain_active_user_profile'])
 
     def post(self, *args, **kwargs):
-        profile = get_profile(self.request.session)
+        profile = get_profile(self.request)
         ingredient = get_object_or_404(Ingredient, pk=kwargs.get('pk'),
                                        owner=profile)
 
@@ -384,6 +626,28 @@ class IngredientDetail(UserPassesTestMixin, generic.DetailView):
                                             args=[ingredient.pk]))
 
 
+def ingredient_picker(request):
+    """Open ingredients as paginated select2 results, searched by ``q``"""
+    profile = get_profile(request)
+    choices = caching.get_or_build(
+        "picker", caching.inventory_key(profile.pk, "picker"),
+        lambda: [(i.pk, str(i)) for i in open_ingredients(profile.pk)])
+
+    terms = request.GET.get('q', '').lower().split()
+    if terms:
+        choices = [(pk, label) for pk, label in choices
+                   if all(term in label.lower() for term in terms)]
+    try:
+        page = Paginator(choices, PICKER_PAGE_SIZE).page(
+            request.GET.get('page', 1))
+    except (EmptyPage, PageNotAnInteger):
+        page = None
+    return HttpResponse(json.dumps({
+        'results': [{'id': pk, 'text': label} for pk, label in page or []],
+        'pagination': {'more': bool(page and page.has_next())},
+    }), content_type="application/json")
+
+
 class IngredientCreate(UserPassesTestMixin, generic.edit.CreateView):
     model = Ingredient
     form_class = IngredientForm
@@ -396,14 +660,38 @@ class IngredientCreate(UserPassesTestMixin, generic.edit.CreateView):
 
     def get_form_kwargs(self):
         kwargs = super(IngredientCreate, self).get_form_kwargs()
-        kwargs['currency'] = get_profile(self.request.session).currency
+        kwargs['currency'] = get_profile(self.request).currency
         return kwargs
 
     def form_valid(self, form):
-        form.instance.owner = get_profile(self.request.session)
+        form.instance.owner = get_profile(self.request)
         return super(IngredientCreate, self).form_valid(form)
 
 
+class ReceiptImport(UserPassesTestMixin, generic.edit.FormView):
+    form_class = ReceiptForm
+    template_name = "grain/receipt_import.html"
+    success_url = reverse_lazy('grain:inventory')
+    login_url = reverse_lazy("grain:profile_list")
+
+    def test_func(self):
+        return 'grain_active_user_profile' in self.request.session
+
+    def form_valid(self, form):
+        try:
+            created, errors = receipts.import_receipt(
+                get_profile(self.request),
+                codecs.iterdecode(form.cleaned_data['receipt'], 'utf-8-sig'))
+        except UnicodeDecodeError:
+            form.add_error('receipt', "Not a UTF-8 text file")
+            return self.form_invalid(form)
+        messages.success(self.request, "Imported %d items" % created)
+        if errors:
+            return self.render_to_response(self.get_context_data(
+                form=ReceiptForm(), errors=errors))
+        return super(ReceiptImport, self).form_valid(form)
+
+
 class UnitList(generic.ListView):
     model = Unit
 
@@ -416,9 +704,11 @@ class UnitCreate(PermissionRequiredMixin, generic.edit.CreateView):
 
 
 class CategoryList(generic.ListView):
-    queryset = IngredientCategory.objects.filter(parent=None)
     template_name = "grain/category_list.html"
 
+    def get_queryset(self):
+        return IngredientCategory.tree()
+
 
 class CategoryCreate(PermissionRequiredMixin, generic.edit.CreateView):
     permission_required = 'grain.can_create_ingredient_category'
@@ -448,27 +738,67 @@ class VendorCreate(PermissionRequiredMixin, generic.edit.CreateView):
 
 class ProductList(UserPassesTestMixin, generic.ListView):
     login_url = reverse_lazy("grain:profile_list")
+    template_name = "grain/product_list.html"
 
     def test_func(self):
         return 'grain_active_user_profile' in self.request.session
 
     def get_queryset(self):
-        profile = get_profile(self.request.session)
-        return Product.objects.filter(price__gt=Money(0, profile.currency))
+        profile = get_profile(self.request)
+        return caching.product_catalogue(profile.currency)
 
 
-def product_raw(request, pk):
-    profile = get_profile(request.session)
-    prod = get_object_or_404(Product, pk=pk,
-                             price__gt=Money(0, profile.currency))
-    prod_dict = {
+def product_dict(prod):
+    return {
         'name': prod.name,
         'usual_price': str(prod.price.amount),
         'amount': prod.amount,
         'units': prod.units.short,
         'fixed': prod.fixed,
     }
-    return HttpResponse(json.dumps(prod_dict))
+
+
+def product_raw(request, pk):
+    profile = get_profile(request)
+    prod = caching.catalogue_products(profile.currency, [int(pk)]).get(
+        int(pk))
+    if prod is None:
+        raise Http404("No product found")
+    return HttpResponse(json.dumps(product_dict(prod)))
+
+
+def batch_products(request):
+    """Products requested as ``?id=1&id=2`` (or ``?ids=1,2``), once per request
+    """
+    if not hasattr(request, 'grain_batch_products'):
+        profile = get_profile(request)
+        pks = request.GET.getlist('id') + request.GET.get('ids', '').split(',')
+        pks = set(int(pk) for pk in pks if pk.isdigit())
+        products = caching.catalogue_products(profile.currency, pks)
+        request.grain_batch_products = [products[pk]
+                                        for pk in sorted(products)]
+    return request.grain_batch_products
+
+
+def product_batch_etag(request):
+    products = batch_products(request)
+    return hashlib.md5(",".join(
+        "%d:%s" % (p.pk, p.updated.isoformat()) for p in products
+    ).encode()).hexdigest()
+
+
+def product_batch_modified(request):
+    products = batch_products(request)
+    if products:
+        return max(p.updated for p in products)
+
+
+@condition(etag_func=product_batch_etag,
+           last_modified_func=product_batch_modified)
+def product_raw_batch(request):
+    return HttpResponse(json.dumps({
+        str(prod.pk): product_dict(prod) for prod in batch_products(request)
+    }), content_type="application/json")
 
 
 class ProductCreate(generic.edit.CreateView):
@@ -478,29 +808,37 @@ class ProductCreate(generic.edit.CreateView):
 
     def get_form_kwargs(self):
         kwargs = super(ProductCreate, self).get_form_kwargs()
-        kwargs['currency'] = get_profile(self.request.session).currency
+        kwargs['currency'] = get_profile(self.request).currency
         return kwargs
 
     def form_valid(self, form):
         if "_add_another" in self.request.POST:
             self.success_url = reverse('grain:product_create')
 
-        form.instance.save()
+        response = super(ProductCreate, self).form_valid(form)
         messages.success(self.request, "Created %s (%s)" %
-            (form.instance, form.instance.price))
-        e = GrainEvent(
-            action=GrainEvent.CREATE,
-            model="Product",
-            object_pk=form.instance.pk,
-            user=self.request.user,
-        )
-        e.save()
-        return super(ProductCreate, self).form_valid(form)
+            (self.object, self.object.price))
+        return response
+
+
+def cache_stats(request):
+    if not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(json.dumps(caching.get_stats("calendar", "picker",
+                                                     "catalogue", "expiring")),
+                        content_type="application/json")
+
+
+def query_stats(request):
+    if not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(json.dumps(instrumentation.get_report()),
+                        content_type="application/json")
 
 
 def ticket_create(request):
     try:
-        profile = get_profile(request.session)
+        profile = get_profile(request)
     except PermissionDenied:
         messages.error(request, "Please select a profile")
         return HttpResponseRedirect(reverse("grain:profile_list"))
@@ -522,6 +860,29 @@ def ticket_create(request):
         args=[form.cleaned_data['dish'].meal.pk]))
 
 
+def ticket_create_bulk(request, pk):
+    try:
+        profile = get_profile(request)
+    except PermissionDenied:
+        messages.error(request, "Please select a profile")
+        return HttpResponseRedirect(reverse("grain:profile_list"))
+    dish = get_object_or_404(Dish, pk=pk, meal__owner=profile)
+
+    formset = TicketLineFormSet(profile.pk, request.POST or None)
+    if request.method == "POST" and formset.is_valid():
+        lines = [(line['ingredient'], line['units_used'], line['exhausted'])
+                 for line in formset.cleaned_data if line]
+        if lines:
+            Ticket.objects.create_tickets(dish, lines, profile.currency)
+            messages.success(request, "Added %d ingredients to %s" %
+                             (len(lines), dish))
+            return HttpResponseRedirect(reverse("grain:meal_detail",
+                                                args=[dish.meal.pk]))
+        messages.error(request, "No ingredients entered")
+    return render(request, "grain/ticket_bulk_form.html",
+                  {'dish': dish, 'formset': formset})
+
+
 class TicketDelete(UserPassesTestMixin, generic.edit.DeleteView):
     login_url = reverse_lazy("grain:profile_list")
 